@@ -33,8 +33,9 @@
 __version__ = '0.1'
 
 from .config import get_config
-from .signing import set_gpghome
-import utils
-import repo
-import signing
 
+
+def set_gpghome(gpghome):
+    # Imported here so that importing arado does not load the signing code
+    from .signing import set_gpghome
+    set_gpghome(gpghome)
@@ -34,20 +34,37 @@
 import os
 import re
 import sys
-
-# Third party libraries
-import requests
+import threading
 
 # Local libraries
 from .config import get_config
 from .exception import PromotionError
-from .utils import links_from_html
+from .metrics import count, span
+from .refcache import get_ref_cache
+from .utils import iter_package_links, parallel_map
+
+
+# The (distro, releasever, arch) repository a build is looked up for
+DEFAULT_TARGET = ("centos", "6", "x86_64")
+
+
+def parse_target(value):
+    """Parse a 'distro/releasever/arch' string into a target tuple."""
+    fields = value.strip().strip("/").split("/")
+    if len(fields) != 3 or not all(fields):
+        raise ValueError("invalid target '{0}': expected distro/releasever/arch".format(value))
+    return tuple(fields)
+
+
+def format_target(target):
+    return "/".join(target)
 
 
 class PathBuilder(object):
-    SOURCE_RE = re.compile('http://[\w\-\.]+/(.*)/centos/6/x86_64') 
+    SOURCE_TEMPL = 'https?://[\w\-\.]+/(.*)/{0}/{1}/{2}/?$'
     DEFAULT_OPTS = {
         "api": None,
+        "project": None,
         "buildtype": None,
         "release": None
     }
@@ -55,6 +72,8 @@ class PathBuilder(object):
     def __init__(self, **opts):
         self.opts = dict(PathBuilder.DEFAULT_OPTS, **opts)
         self.api = self.opts.get('api')
+        # Destination paths need only the project, not a build
+        self.project = self.opts.get('project') or getattr(self.api, 'project', None)
         self.buildtype = self.opts.get('buildtype')
         self.release = self.opts.get('release')
         self.config = get_config()
@@ -62,14 +81,26 @@ class PathBuilder(object):
     @property
     def mapping(self):
         try:
-            return self.config.mappings().get(self.api.project)
+            return self.config.mappings().get(self.project)
         except:
             return None
 
+    @property
+    def source_re(self):
+        target = getattr(self.api, 'target', DEFAULT_TARGET)
+        return re.compile(self.SOURCE_TEMPL.format(*[re.escape(f) for f in target]))
+
     @property
     def source_path(self):
-        path = self.SOURCE_RE.match(self.api.repository).groups()[0]
-        return os.path.join(self.config.paths().get('source'), path)
+        match = self.source_re.match(self.api.repository)
+        if match is None:
+            raise PromotionError("unexpected repository '{0}'".format(self.api.repository))
+        return os.path.join(self.config.paths().get('source'), match.groups()[0])
+
+    @property
+    def target_dir(self):
+        """The directory of the build's target, relative to source_path."""
+        return format_target(getattr(self.api, 'target', DEFAULT_TARGET))
 
     @property
     def dest_path(self):
@@ -81,13 +112,24 @@ class PathBuilder(object):
                     self.mapping, self.release)
 
 
+# Repository URLs already resolved in this process, keyed by
+# (api and target, project url, commit)
+_repositories = {}
+_repositories_lock = threading.Lock()
+
+
 class APIWrapper(object):
-    API_TEMPL = "{0}?distro=centos&releasever=6&arch=x86_64&url={1}&ref={2}&allow-old=true"
+    API_TEMPL = "{0}&url={1}&ref={2}&allow-old=true"
+    TARGET_TEMPL = "{0}?distro={1}&releasever={2}&arch={3}"
 
-    def __init__(self, project, commit):
+    def __init__(self, project, commit, client=None, use_cache=True, target=None):
         self.project = project
         self.commit = commit
+        self.target = tuple(target or DEFAULT_TARGET)
         self.config = get_config()
+        self._client = client
+        self.use_cache = use_cache
+        self._ref_cache = None
         self.cached_packages = None
 
     @property
@@ -104,24 +146,142 @@ class APIWrapper(object):
         except:
             return None
 
+    @property
+    def key(self):
+        # The target is part of the API url so that each target of a
+        # commit is cached separately
+        return (APIWrapper.TARGET_TEMPL.format(self.api, *self.target),
+                self.url, self.commit)
+
+    @property
+    def client(self):
+        # requests is only imported once a lookup misses the cache
+        if self._client is None:
+            from .client import get_client
+            self._client = get_client()
+        return self._client
+
+    @property
+    def ref_cache(self):
+        # The cache is only opened once a lookup uses it
+        if self._ref_cache is None and self.use_cache:
+            self._ref_cache = get_ref_cache()
+        return self._ref_cache
+
+    def _cached(self):
+        if not self.use_cache:
+            return None
+        return self.ref_cache.get(self.key)
+
+    def _store(self, repository, packages=None):
+        if self.use_cache:
+            self.ref_cache.put(self.key, repository, packages)
+
     @property
     def repository(self):
-        r = requests.get(APIWrapper.API_TEMPL.format(self.api, self.url, self.commit))
-        if r.status_code != 200:
-            raise PromotionError(r.text)
-        return r.text.rstrip()
+        if self.url is None:
+            raise PromotionError("unknown project '{0}'".format(self.project))
+        key = self.key
+        with _repositories_lock:
+            if key in _repositories:
+                return _repositories[key]
+        cached = self._cached()
+        if cached:
+            count("api_cache_hits")
+            repository = cached[0]
+        else:
+            with span("api", request="repository"):
+                r = self.client.get(APIWrapper.API_TEMPL.format(*key))
+                if r.status_code != 200:
+                    raise PromotionError(r.text)
+                repository = r.text.rstrip()
+            self._store(repository)
+        with _repositories_lock:
+            _repositories[key] = repository
+        return repository
 
     @property
     def packages(self):
-        try:
-            if not self.cached_packages:
-                r = requests.get(self.repository + "?F=0&P=*.rpm")
+        if not self.cached_packages:
+            cached = self._cached()
+            if cached and cached[1] is not None and cached[0] == self.repository:
+                count("api_cache_hits")
+                self.cached_packages = cached[1]
+                return self.cached_packages
+            with span("api", request="packages") as api_span:
+                r = self.client.get(self.repository + "?F=0&P=*.rpm",
+                                    stream=True)
                 if r.status_code != 200:
                     raise PromotionError(r.text)
-                # Store list and remove the first item since
-                # it is parent directory
-                self.cached_packages = links_from_html(r.text)[1:]
-            return self.cached_packages
+                try:
+                    self.cached_packages = list(
+                        iter_package_links(r.iter_content(64 * 1024)))
+                except Exception as err:
+                    raise PromotionError("listing {0} failed: {1}".format(
+                        self.repository, err))
+                api_span.add(files=len(self.cached_packages))
+            self._store(self.repository, self.cached_packages)
+        return self.cached_packages
+
+def read_refs(fp):
+    """Read (project, commit) pairs from a file, one pair per line.
+
+    Blank lines and lines starting with '#' are ignored.
+    """
+    pairs = []
+    for lineno, line in enumerate(fp, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = line.split()
+        if len(fields) != 2:
+            raise ValueError("line {0}: expected 'project commit'".format(lineno))
+        pairs.append(tuple(fields))
+    return pairs
+
+
+def read_manifest(fp, release=None, buildtype="nightly"):
+    """Read the builds of a promotion manifest, one per line.
+
+    Each line holds a project and a commit, optionally followed by the
+    release and the build type, which otherwise default to release and
+    buildtype. Blank lines and lines starting with '#' are ignored.
+    Returns a list of (project, commit, release, buildtype) tuples.
+    """
+    builds = []
+    for lineno, line in enumerate(fp, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = line.split()
+        if not 2 <= len(fields) <= 4:
+            raise ValueError("line {0}: expected 'project commit [release [type]]'".format(lineno))
+        fields += [release, buildtype][len(fields) - 2:]
+        if fields[2] is None:
+            raise ValueError("line {0}: no release given".format(lineno))
+        builds.append(tuple(fields))
+    return builds
+
+
+def resolve_many(pairs, resolve, concurrency=None, use_cache=True):
+    """Resolve many (project, commit) pairs concurrently.
+
+    resolve is called with an APIWrapper for each pair and returns a
+    dict of results. Up to concurrency pairs (api-concurrency in
+    [general] by default) are resolved at once. Returns a list of dicts,
+    in the order of pairs, holding the project, the commit and either
+    the results or an error message.
+    """
+    if concurrency is None:
+        concurrency = get_config().general().getint('api-concurrency', 8)
+
+    def _resolve(pair):
+        project, commit = pair
+        result = {"project": project, "commit": commit}
+        try:
+            result.update(resolve(APIWrapper(project, commit, use_cache=use_cache)))
         except Exception as err:
-            print("exception: {0}".format(err)) 
-            return []
+            result["error"] = str(err)
+        return result
+
+    return parallel_map(_resolve, pairs, concurrency)
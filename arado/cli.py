@@ -0,0 +1,538 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+"""The arado command and its subcommands.
+
+Each subcommand imports what it needs when it runs, so that, for
+example, describing a commit does not load the signing code.
+"""
+
+import json
+import os
+import shutil
+import sys
+
+from argparse import ArgumentParser
+
+from . import __version__
+from .config import get_config
+
+
+def _add_build_arguments(parser, release=False):
+    parser.add_argument("--project", dest="project",
+        help="project for build promotion (e.g. eucalyptus)")
+    parser.add_argument("--commit", dest="commit",
+        help="reference to a commit; either a hash, tag, or branch")
+    if release:
+        parser.add_argument("--release", dest="release",
+            help="point-release version (e.g. 3.2)")
+        parser.add_argument("--type", dest="buildtype", default="nightly",
+            help="optionally supply a build type (release, prerelease, nightly)")
+
+
+def _add_signing_arguments(parser):
+    parser.add_argument("--key", dest="signingkey",
+        help="optionally supply a signing key (release, prerelease, nightly)")
+    parser.add_argument("--gpgdir", dest="gpgdir",
+        help="optionally supply gpg key directory")
+
+
+def _add_lookup_arguments(parser, batch=False):
+    parser.add_argument("--no-cache", action="store_false", dest="use_cache", default=True,
+        help="neither read nor store cached build lookups")
+    if batch:
+        parser.add_argument("--batch", dest="batch", metavar="FILE",
+            help="describe each 'project commit' line of FILE ('-' for stdin) as JSON lines")
+        parser.add_argument("--concurrency", dest="concurrency", type=int,
+            help="number of commits resolved at once in batch mode")
+
+
+def _add_metrics_arguments(parser):
+    parser.add_argument("--metrics-json", dest="metrics_json", metavar="FILE",
+        help="write the run's timings to FILE as JSON")
+    parser.add_argument("--metrics-textfile", dest="metrics_textfile", metavar="FILE",
+        help="write the run's timings to FILE for the Prometheus textfile collector")
+
+
+def _write_metrics(args, success):
+    """Write the metrics of this run where the options or config ask."""
+    try:
+        paths = get_config().paths()
+    except Exception:
+        paths = {}
+    json_path = args.metrics_json or paths.get('metrics-json')
+    textfile = args.metrics_textfile or paths.get('metrics-textfile')
+    if not (json_path or textfile):
+        return
+    from .metrics import get_recorder
+    recorder = get_recorder()
+    command = args.command
+    try:
+        if json_path:
+            recorder.write_json(json_path.format(command=command), success)
+        if textfile:
+            recorder.write_prometheus(textfile.format(command=command), success,
+                                      subcommand=command)
+    except (IOError, OSError) as err:
+        print("Warning: unable to write metrics: {0}".format(err))
+
+
+def _run_batch(args, describe):
+    """Describe each pair of the batch file as a line of JSON on stdout.
+
+    A pair that cannot be described has an error field instead of the
+    results, and the exit status is 1.
+    """
+    from .api import read_refs, resolve_many
+    try:
+        if args.batch == "-":
+            pairs = read_refs(sys.stdin)
+        else:
+            with open(args.batch) as fp:
+                pairs = read_refs(fp)
+    except (IOError, ValueError) as err:
+        args.parser.error("{0}: {1}".format(args.batch, err))
+    status = 0
+    for result in resolve_many(pairs, describe, args.concurrency,
+                               args.use_cache):
+        if "error" in result:
+            status = 1
+        print(json.dumps(result))
+    return status
+
+
+def describe_build(api):
+    return {"repository": api.repository, "packages": api.packages}
+
+
+def describe_commit(api):
+    from .api import PathBuilder
+    builder = PathBuilder(api=api, buildtype="nightly")
+    return {"build": os.path.basename(builder.source_path).split("-")[0]}
+
+
+def cmd_describe_build(args):
+    if args.batch:
+        return _run_batch(args, describe_build)
+    if None in (args.project, args.commit):
+        args.parser.error("Must specify project and commit ref!")
+
+    from .api import APIWrapper, PathBuilder
+    api = APIWrapper(args.project, args.commit, use_cache=args.use_cache)
+    if args.details:
+        from . import repo
+        builder = PathBuilder(api=api)
+        for name, info in repo.describe(builder.source_path):
+            print("{0} {1} {2} {3}".format(name, info.nevra,
+                                           info.sigkey or "unsigned", info.size))
+    else:
+        from .exception import AradoException
+        try:
+            packages = api.packages
+        except AradoException as err:
+            print("Error: unable to list packages: {0}".format(err))
+            return 1
+        for p in packages:
+            print(p)
+    return 0
+
+
+def cmd_describe_commit(args):
+    if args.batch:
+        return _run_batch(args, describe_commit)
+    if None in (args.project, args.commit):
+        args.parser.error("Must specify project and commit ref!")
+
+    from .api import APIWrapper
+    api = APIWrapper(args.project, args.commit, use_cache=args.use_cache)
+    print(describe_commit(api)["build"])
+    return 0
+
+
+def _resolve_builds(builds, use_cache=True, targets=None):
+    """Look up the source and destination paths of builds concurrently.
+
+    builds are (project, commit, release, buildtype) tuples. Returns a
+    list of (source_path, dest_path) in the same order. With targets,
+    each build is looked up for every (distro, releasever, arch) target
+    and the source is a (target directory, directory under dest_path)
+    pair.
+    """
+    from .api import APIWrapper, PathBuilder
+    from .utils import parallel_map
+
+    def _resolve(item):
+        (project, commit, release, buildtype), target = item
+        api = APIWrapper(project, commit, use_cache=use_cache, target=target)
+        builder = PathBuilder(api=api, buildtype=buildtype, release=release)
+        if target is None:
+            return builder.source_path, builder.dest_path
+        source = os.path.join(builder.source_path, builder.target_dir)
+        return (source, builder.target_dir), builder.dest_path
+
+    items = [(build, target) for build in builds for target in targets or [None]]
+    workers = get_config().general().getint('api-concurrency', 8)
+    return parallel_map(_resolve, items, workers)
+
+
+def _get_targets(args):
+    """Return the targets of a matrix promotion, or None."""
+    from .api import parse_target
+
+    values = list(args.targets or [])
+    if args.all_targets:
+        values += get_config().general().get('targets', '').replace(',', ' ').split()
+        if not values:
+            args.parser.error("no targets in the [general] section of the configuration!")
+    targets = []
+    for value in values:
+        try:
+            target = parse_target(value)
+        except ValueError as err:
+            args.parser.error(str(err))
+        if target not in targets:
+            targets.append(target)
+    return targets or None
+
+
+def _promote(sources, dest_path, args):
+    """Stage dest_path once, merge every source into it and publish it.
+
+    The promotion's journal is locked until it returns.
+    """
+    from .exception import AradoException
+    from .journal import Journal
+
+    try:
+        journal = Journal.open({"sources": sources,
+                                "dest": dest_path,
+                                "merge": args.merge,
+                                "key": args.signingkey})
+    except AradoException as err:
+        print("Error: {0}".format(err))
+        return 1
+    try:
+        return _promote_journaled(sources, dest_path, args, journal)
+    finally:
+        journal.close()
+
+
+def _promote_journaled(sources, dest_path, args, journal):
+    from . import repo
+    from .exception import AradoException
+
+    if journal.resumable(dest_path) and not args.restart:
+        temp_repo = journal.staged
+        print("Info: resuming promotion staged in {0}".format(temp_repo))
+    else:
+        if journal.staged:
+            print("Info: discarding earlier attempt staged in {0}".format(journal.staged))
+            shutil.rmtree(journal.staged, ignore_errors=True)
+        temp_repo = repo.stage(dest_path, args.merge)
+        journal.start(temp_repo, dest_path)
+    try:
+        if args.targets:
+            repo.merge_targets(sources, temp_repo, args.signingkey,
+                               origin=dest_path, journal=journal)
+        elif len(sources) == 1:
+            repo.merge(sources[0], temp_repo, args.signingkey,
+                       origin=dest_path, journal=journal)
+        else:
+            repo.merge_many(sources, temp_repo, args.signingkey,
+                            origin=dest_path, journal=journal)
+    except AradoException as err:
+        print("Error: promotion failed: {0}".format(err))
+        print("Error: rerun the promotion to resume from {0}".format(temp_repo))
+        return 1
+    repo.replace(temp_repo, dest_path)
+    journal.discard()
+    return 0
+
+
+def cmd_promote_build(args):
+    if args.manifest:
+        if args.project or args.commit:
+            args.parser.error("--manifest cannot be used with project and commit!")
+        from .api import read_manifest
+        fp = sys.stdin if args.manifest == "-" else open(args.manifest)
+        try:
+            builds = read_manifest(fp, args.release, args.buildtype)
+        except ValueError as err:
+            args.parser.error("{0}: {1}".format(args.manifest, err))
+    elif None in (args.project, args.commit, args.release):
+        args.parser.error("Must specify project, commit and release!")
+    else:
+        builds = [(args.project, args.commit, args.release, args.buildtype)]
+
+    targets = _get_targets(args)
+    # Resolved targets replace the option values for _promote
+    args.targets = targets
+
+    from . import repo
+    from .exception import AradoException
+
+    if args.gpgdir:
+        from . import signing
+        signing.set_gpghome(args.gpgdir)
+
+    try:
+        resolved = _resolve_builds(builds, args.use_cache, targets)
+    except AradoException as err:
+        print("Error: unable to find build: {0}".format(err))
+        return 1
+    # Each destination is staged and published once, with every build
+    # that maps to it merged in manifest order
+    destinations = []
+    sources = {}
+    for source_path, dest_path in resolved:
+        if dest_path not in sources:
+            destinations.append(dest_path)
+            sources[dest_path] = []
+        if source_path not in sources[dest_path]:
+            sources[dest_path].append(source_path)
+
+    if args.dry_run:
+        for dest_path in destinations:
+            for source_path in sources[dest_path]:
+                dest = dest_path
+                if targets:
+                    source_path, reldir = source_path
+                    dest = os.path.join(dest_path, reldir)
+                print("Info: {0} -> {1}".format(source_path, dest))
+                print(repo.plan_merge(source_path, dest if args.merge else None).report())
+        return 0
+
+    status = 0
+    for dest_path in destinations:
+        if len(sources[dest_path]) > 1:
+            print("Info: promoting {0} {1} to {2}".format(
+                len(sources[dest_path]), "targets" if targets else "builds",
+                dest_path))
+        status = _promote(sources[dest_path], dest_path, args) or status
+    return status
+
+
+def cmd_rebuild_repo(args):
+    if None in (args.project, args.commit, args.release):
+        args.parser.error("Must specify project, commit and release!")
+
+    from . import repo
+    from .api import APIWrapper, PathBuilder
+    from .exception import AradoException
+
+    if args.gpgdir:
+        from . import signing
+        signing.set_gpghome(args.gpgdir)
+
+    api = APIWrapper(args.project, args.commit)
+    builder = PathBuilder(api=api, buildtype=args.buildtype, release=args.release)
+
+    temp_repo = repo.stage(builder.dest_path, True)
+    try:
+        if args.signingkey:
+            repo.sign(temp_repo, args.signingkey, force=args.force)
+        else:
+            print("Warning: no signing key given; packages are not signed")
+        repo.rebuild_all(temp_repo, origin=builder.dest_path)
+        repo.replace(temp_repo, builder.dest_path)
+    except AradoException as err:
+        print("Error: rebuild failed: {0}".format(err))
+        return 1
+    finally:
+        shutil.rmtree(temp_repo, ignore_errors=True)
+    return 0
+
+
+def cmd_prune(args):
+    if args.path is None and None in (args.project, args.release):
+        args.parser.error("Must specify project and release, or path!")
+    if args.keep is not None and args.keep < 1:
+        args.parser.error("Must keep at least one version of each package!")
+
+    from . import repo
+    from .exception import AradoException
+
+    if args.path:
+        dest_path = os.path.abspath(args.path)
+    else:
+        from .api import PathBuilder
+        builder = PathBuilder(project=args.project, buildtype=args.buildtype,
+                              release=args.release)
+        dest_path = builder.dest_path
+    if not os.path.isdir(dest_path):
+        print("Error: no repository at {0}".format(dest_path))
+        return 1
+
+    plan = repo.plan_prune(dest_path, args.keep)
+    if args.dry_run:
+        print(plan.report())
+        return 0
+    if not plan.remove:
+        print("Info: nothing to prune in {0}".format(dest_path))
+        return 0
+
+    temp_repo = repo.stage(dest_path, True)
+    try:
+        repo.prune(temp_repo, args.keep, origin=dest_path)
+    except AradoException as err:
+        print("Error: prune failed: {0}".format(err))
+        shutil.rmtree(temp_repo, ignore_errors=True)
+        return 1
+    repo.replace(temp_repo, dest_path)
+    return 0
+
+
+def cmd_cleanup(args):
+    from .journal import find_orphans, remove_journal
+    max_age = args.max_age
+    if max_age is None:
+        max_age = get_config().general().getfloat('cleanup-max-age', 72)
+    journals, dirs = find_orphans(max_age * 3600)
+    for path in journals:
+        if args.dry_run:
+            print("Info: removing abandoned journal {0}".format(path))
+        elif remove_journal(path, remove_staged=True):
+            print("Info: removed abandoned journal {0}".format(path))
+        else:
+            print("Info: skipping journal {0} in use".format(path))
+    for path in dirs:
+        print("Info: removing abandoned staging directory {0}".format(path))
+        if not args.dry_run:
+            shutil.rmtree(path, ignore_errors=True)
+    if not (journals or dirs):
+        print("Info: nothing to clean up")
+    return 0
+
+
+def build_parser():
+    parser = ArgumentParser(prog="arado",
+                            description="Arado Package Repository Tools")
+    parser.add_argument("--version", action="version",
+                        version="%(prog)s {0}".format(__version__))
+    commands = parser.add_subparsers(title="commands")
+
+    p = commands.add_parser("describe-build",
+        help="describe the packages associated with a build",
+        description="Describe the packages associated with a build")
+    _add_build_arguments(p)
+    p.add_argument("--details", action="store_true", dest="details", default=False,
+        help="describe the packages in the local build tree")
+    _add_lookup_arguments(p, batch=True)
+    _add_metrics_arguments(p)
+    p.set_defaults(func=cmd_describe_build, parser=p, command="describe-build")
+
+    p = commands.add_parser("describe-commit",
+        help="show the build number of a commit",
+        description="Show the build number of a commit")
+    _add_build_arguments(p)
+    _add_lookup_arguments(p, batch=True)
+    _add_metrics_arguments(p)
+    p.set_defaults(func=cmd_describe_commit, parser=p, command="describe-commit")
+
+    p = commands.add_parser("promote-build",
+        help="promote a build to the release repository",
+        description="""Promote a continuous integration build to the release
+            repository""")
+    _add_build_arguments(p, release=True)
+    _add_signing_arguments(p)
+    p.add_argument("--merge", action="store_true", dest="merge", default=False,
+        help="merge build with repository (default: overwrite repository)")
+    p.add_argument("--dry-run", action="store_true", dest="dry_run", default=False,
+        help="show the files that would be added and replaced, then exit")
+    p.add_argument("--restart", action="store_true", dest="restart", default=False,
+        help="start again rather than resume an interrupted promotion")
+    p.add_argument("--manifest", dest="manifest", metavar="FILE",
+        help="promote each 'project commit [release [type]]' line of FILE ('-' for stdin)")
+    p.add_argument("--target", action="append", dest="targets",
+        metavar="DISTRO/RELEASEVER/ARCH",
+        help="promote the build of this target; may be given more than once")
+    p.add_argument("--all-targets", action="store_true", dest="all_targets", default=False,
+        help="promote the build of every target listed in the configuration")
+    _add_lookup_arguments(p)
+    _add_metrics_arguments(p)
+    p.set_defaults(func=cmd_promote_build, parser=p, command="promote-build")
+
+    p = commands.add_parser("rebuild-repo",
+        help="re-sign and re-index a repository",
+        description="""Rebuild an existing repository by resigning package
+            and rebuilding metadata""")
+    _add_build_arguments(p, release=True)
+    _add_signing_arguments(p)
+    p.add_argument("--force", action="store_true", dest="force", default=False,
+        help="re-sign packages already signed with the key")
+    _add_metrics_arguments(p)
+    p.set_defaults(func=cmd_rebuild_repo, parser=p, command="rebuild-repo")
+
+    p = commands.add_parser("prune",
+        help="remove old package versions from a repository",
+        description="""Remove all but the newest versions of each package
+            from a repository, then rebuild its metadata and publish it""")
+    p.add_argument("--project", dest="project",
+        help="project whose repository is pruned (e.g. eucalyptus)")
+    p.add_argument("--release", dest="release",
+        help="point-release version (e.g. 3.2)")
+    p.add_argument("--type", dest="buildtype", default="nightly",
+        help="build type of the repository (default: nightly)")
+    p.add_argument("--path", dest="path",
+        help="prune the repository at PATH instead")
+    p.add_argument("--keep", dest="keep", type=int,
+        help="versions of each package to keep (default: prune-keep in [general])")
+    p.add_argument("--dry-run", action="store_true", dest="dry_run", default=False,
+        help="show the files that would be removed, then exit")
+    _add_metrics_arguments(p)
+    p.set_defaults(func=cmd_prune, parser=p, command="prune")
+
+    p = commands.add_parser("cleanup",
+        help="remove staging directories left by failed runs",
+        description="""Remove the staging directories and journals of
+            promotions that were abandoned, and are older than the maximum
+            age""")
+    p.add_argument("--max-age", dest="max_age", type=float,
+        help="hours before an abandoned run is removed (default: cleanup-max-age in [general])")
+    p.add_argument("--dry-run", action="store_true", dest="dry_run", default=False,
+        help="show what would be removed, then exit")
+    _add_metrics_arguments(p)
+    p.set_defaults(func=cmd_cleanup, parser=p, command="cleanup")
+
+    return parser
+
+
+def main(argv=None):
+    """Run the arado command line, returning its exit status."""
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    status = 1
+    try:
+        status = args.func(args)
+    finally:
+        _write_metrics(args, status == 0)
+    return status
@@ -0,0 +1,102 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+import sys
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .config import get_config
+from .exception import PromotionError
+from .metrics import count
+
+
+class APIClient(object):
+    """A pooled HTTP client for the build API.
+
+    Connections are kept alive and shared between threads through a
+    single requests Session. Requests time out after timeout seconds and
+    connection errors, timeouts and 5xx responses are retried up to
+    retries times, waiting backoff * 2 ** attempt seconds in between.
+    """
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, timeout=30, retries=3, backoff=0.5, pool_size=10,
+                 session=None):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        attempt = 0
+        while True:
+            try:
+                response = self.session.get(url, **kwargs)
+                if (response.status_code not in self.RETRY_STATUSES or
+                        attempt >= self.retries):
+                    return response
+                reason = "status {0}".format(response.status_code)
+                response.close()
+            except (requests.ConnectionError, requests.Timeout) as err:
+                if attempt >= self.retries:
+                    raise PromotionError("request to {0} failed: {1}".format(url, err))
+                reason = str(err)
+            delay = self.backoff * 2 ** attempt
+            # stderr, so that batch output on stdout stays valid JSON lines
+            sys.stderr.write("Info: retrying {0} in {1:.1f}s ({2})\n".format(
+                url, delay, reason))
+            count("api_retries")
+            time.sleep(delay)
+            attempt += 1
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide APIClient configured in [general]."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            general = get_config().general()
+            _client = APIClient(timeout=general.getfloat('api-timeout', 30),
+                                retries=general.getint('api-retries', 3),
+                                backoff=general.getfloat('api-backoff', 0.5))
+        return _client
@@ -33,6 +33,8 @@
 import grp
 import os
 import pwd
+import threading
+from collections import Mapping
 
 from ConfigParser import SafeConfigParser
 
@@ -41,19 +43,87 @@ from .exception import ConfigError
 __all__ = ['get_config']
 
 
+class Section(Mapping):
+    """A read-only config section with typed accessors.
+
+    Calling a section returns it, so config.general() reads the same as
+    it always has.
+    """
+
+    def __init__(self, name, items):
+        self.name = name
+        self._items = dict(items)
+
+    def __call__(self):
+        return self
+
+    def __getitem__(self, key):
+        return self._items[key]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __repr__(self):
+        return '<section: {0}>'.format(self.name)
+
+    def _convert(self, key, default, convert, kind):
+        value = self._items.get(key)
+        if value is None or value == '':
+            return default
+        try:
+            return convert(value)
+        except ValueError:
+            raise ConfigError("invalid {0} for '{1}' in [{2}]: '{3}'".format(
+                kind, key, self.name, value))
+
+    def getint(self, key, default=None):
+        return self._convert(key, default, int, "integer")
+
+    def getfloat(self, key, default=None):
+        return self._convert(key, default, float, "number")
+
+    def getbool(self, key, default=None):
+        def _bool(value):
+            value = value.lower()
+            if value in ('1', 'yes', 'true', 'on'):
+                return True
+            elif value in ('0', 'no', 'false', 'off'):
+                return False
+            raise ValueError(value)
+        return self._convert(key, default, _bool, "boolean")
+
+    def getperms(self, key, default=None):
+        """Read file permissions written in octal, e.g. 664."""
+        return self._convert(key, default, lambda value: int(value, 8),
+                             "octal mode")
+
+    def getpath(self, key, default=None):
+        value = self._items.get(key) or default
+        if value is None:
+            return None
+        return os.path.abspath(os.path.expanduser(value))
+
+
 class Config(SafeConfigParser):
+    CATEGORIES = ('general', 'paths', 'projects', 'mappings')
+
     def __init__(self, config_file):
         SafeConfigParser.__init__(self)
         self.config_file = config_file
         self.read(config_file)
+        self._sections_cache = dict(
+            (name, Section(name, self.items(name) if self.has_section(name) else []))
+            for name in self.CATEGORIES)
 
     def __getattr__(self, name):
-        def _search_config(*args, **kwargs):
-            if name not in ('general', 'paths', 'projects', 'mappings'):
-                raise ConfigError("unknown category '{0}'".format(name))
-            return dict((key, self.get(name, key))
-                for key in self.options(name))
-        return _search_config
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self.CATEGORIES:
+            raise ConfigError("unknown category '{0}'".format(name))
+        return self._sections_cache[name]
 
     def __repr__(self):
         return '<config: {0}>'.format(self.config_file)
@@ -82,13 +152,36 @@ class Config(SafeConfigParser):
             return 0
 
 
-def get_config():
-    if os.path.isfile('/etc/arado.conf'):
-        return Config('/etc/arado.conf')
+def find_config():
+    if os.environ.get('ARADO_CONFIG'):
+        if not os.path.isfile(os.environ['ARADO_CONFIG']):
+            raise Exception("no config file found at {0}!".format(
+                os.environ['ARADO_CONFIG']))
+        return os.environ['ARADO_CONFIG']
+    elif os.path.isfile('/etc/arado.conf'):
+        return '/etc/arado.conf'
     elif os.path.isfile(os.path.join(os.getcwd(), 'arado.conf')):
-        return Config(os.path.join(os.getcwd(), 'arado.conf'))
+        return os.path.join(os.getcwd(), 'arado.conf')
     elif os.path.isfile(os.path.expanduser('~/.arado.conf')):
-        return Config((os.path.expanduser('~/.arado.conf')))
+        return os.path.expanduser('~/.arado.conf')
     else:
         raise Exception("no config file found!")
 
+
+_configs = {}
+_configs_lock = threading.Lock()
+
+
+def get_config():
+    """Return the Config for the config file in use.
+
+    The parsed file is shared by every caller until its mtime changes.
+    """
+    config_file = find_config()
+    mtime = os.stat(config_file).st_mtime
+    with _configs_lock:
+        cached = _configs.get(config_file)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, Config(config_file))
+            _configs[config_file] = cached
+        return cached[1]
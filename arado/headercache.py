@@ -0,0 +1,153 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+import os
+import sqlite3
+import threading
+
+from .config import get_config
+from .rpmfile import PackageInfo, RPMFileError, read_package
+from .utils import makedirs, parallel_map
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS packages (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    name TEXT,
+    epoch TEXT,
+    version TEXT,
+    release TEXT,
+    arch TEXT,
+    sha256 TEXT,
+    content TEXT,
+    sigkey TEXT,
+    PRIMARY KEY (dev, ino, size, mtime)
+)
+"""
+
+
+def _stat_key(filename):
+    st = os.stat(filename)
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+
+
+class HeaderCache(object):
+    """A persistent cache of RPM headers and digests.
+
+    Entries are keyed by the device, inode, size and mtime of the file,
+    so any rewrite of a package (signing replaces the file) misses the
+    cache. Missing entries are read lazily, in parallel for batches.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.dirname(path):
+            makedirs(os.path.dirname(path))
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.db.execute(SCHEMA)
+        self.db.commit()
+
+    def _lookup(self, key):
+        row = self.db.execute(
+            "SELECT name, epoch, version, release, arch, sha256, content, "
+            "sigkey FROM packages WHERE dev=? AND ino=? AND size=? AND mtime=?",
+            key).fetchone()
+        if row is None:
+            return None
+        return PackageInfo(*(list(row) + [key[2]]))
+
+    def _store(self, entries):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO packages VALUES (?, ?, ?, ?, ?, ?, ?, ?, "
+            "?, ?, ?, ?)",
+            [tuple(key) + tuple(info[:8]) for key, info in entries])
+        self.db.commit()
+
+    def get(self, filename):
+        """Return the PackageInfo for filename."""
+        return self.get_many([filename])[filename]
+
+    def get_many(self, filenames, workers=1):
+        """Return a dict of filename to PackageInfo.
+
+        Packages that are not cached are read with up to workers threads.
+        Files that cannot be read as RPMs are left out.
+        """
+        results = {}
+        missing = []
+        with self.lock:
+            for filename in filenames:
+                try:
+                    key = _stat_key(filename)
+                except OSError:
+                    continue
+                info = self._lookup(key)
+                if info is None:
+                    missing.append((filename, key))
+                else:
+                    results[filename] = info
+
+        def _read(item):
+            filename, key = item
+            try:
+                return key, read_package(filename)
+            except (IOError, RPMFileError):
+                return key, None
+
+        read = parallel_map(_read, missing, workers)
+        with self.lock:
+            self._store([entry for entry in read if entry[1] is not None])
+        for (filename, _), (key, info) in zip(missing, read):
+            if info is not None:
+                results[filename] = info
+        return results
+
+    def close(self):
+        self.db.close()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_header_cache():
+    """Return the HeaderCache configured in [paths]."""
+    paths = get_config().paths()
+    path = paths.getpath('header-cache') or os.path.join(
+        paths.getpath('repotemp', '/var/tmp'), "arado-cache", "headers.sqlite")
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = HeaderCache(path)
+        return _caches[path]
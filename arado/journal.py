@@ -0,0 +1,282 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+"""Journals that let an interrupted promotion be resumed.
+
+A journal records where a promotion was staged and the steps that have
+completed, under <repotemp>/arado-journal. Rerunning the same promotion
+picks up the staged tree and skips the completed steps.
+"""
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from .config import get_config
+from .exception import PromotionError
+from .utils import makedirs
+
+STAGING_PREFIX = "arado-stage-"
+
+
+def journal_dir():
+    tmpdir = get_config().paths().getpath('repotemp', '/var/tmp')
+    return os.path.join(tmpdir, "arado-journal")
+
+
+def _lock_file(path):
+    """Open path and take an exclusive lock on it.
+
+    Returns the file descriptor, or None if another process holds the
+    lock.
+    """
+    while True:
+        fd = os.open(path, os.O_CREAT | os.O_RDWR, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as err:
+            os.close(fd)
+            if err.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return None
+            raise
+        # The previous owner removes the file when it is done; if that
+        # happened before the lock was taken, lock the new file instead
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except OSError:
+            pass
+        os.close(fd)
+
+
+def _is_locked(path):
+    """True if a process holds the lock on path."""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as err:
+        if err.errno == errno.ENOENT:
+            return False
+        raise
+    try:
+        fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except IOError as err:
+        if err.errno in (errno.EWOULDBLOCK, errno.EAGAIN):
+            return True
+        raise
+    finally:
+        os.close(fd)
+    return False
+
+
+def _origin_state(path):
+    """Identify the published state of path, to notice it changing."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_ino, st.st_mtime, os.path.realpath(path)]
+
+
+class Journal(object):
+    """The recorded progress of one promotion.
+
+    A promotion is identified by a dict of the settings that determine
+    its result, such as the build and destination. Steps are recorded as
+    (step, item) pairs, e.g. ("signed", "rhel/6/x86_64"). An open journal
+    holds a lock on <journal>.lock until it is closed or discarded, so
+    only one process at a time runs a promotion.
+    """
+
+    def __init__(self, path, identity):
+        self.path = path
+        self.identity = identity
+        self.lock = threading.Lock()
+        self.lock_path = os.path.splitext(path)[0] + ".lock"
+        self.lock_fd = None
+        self.data = {"identity": identity, "created": time.time(),
+                     "pid": os.getpid(), "staged": None, "origin": None,
+                     "steps": []}
+
+    @classmethod
+    def open(cls, identity, directory=None):
+        """Lock and load the journal for identity, or start a new one.
+
+        Raises a PromotionError if another process holds the journal.
+        """
+        directory = directory or journal_dir()
+        makedirs(directory)
+        key = hashlib.sha1(json.dumps(identity, sort_keys=True)).hexdigest()
+        journal = cls(os.path.join(directory, key + ".json"), identity)
+        journal.lock_fd = _lock_file(journal.lock_path)
+        if journal.lock_fd is None:
+            raise PromotionError("promotion already in progress")
+        try:
+            if os.path.exists(journal.path):
+                with open(journal.path) as fp:
+                    journal.data = json.load(fp)
+                # Note the new owner, so the journal does not look
+                # abandoned while this run uses it
+                journal.data.update(pid=os.getpid(), created=time.time())
+                journal._save()
+        except:
+            journal.close()
+            raise
+        return journal
+
+    @property
+    def staged(self):
+        return self.data["staged"]
+
+    def resumable(self, origin):
+        """True if the staged tree exists and origin has not changed."""
+        return bool(self.staged and os.path.isdir(self.staged) and
+                    self.data["origin"] == _origin_state(origin))
+
+    def start(self, staged, origin):
+        """Begin the journal afresh for a tree staged from origin."""
+        with self.lock:
+            self.data.update(staged=staged, origin=_origin_state(origin),
+                             created=time.time(), steps=[])
+            self._save()
+
+    def done(self, step, item=None):
+        with self.lock:
+            return [step, item] in self.data["steps"]
+
+    @property
+    def steps(self):
+        return [tuple(step) for step in self.data["steps"]]
+
+    def record(self, step, item=None):
+        with self.lock:
+            if [step, item] not in self.data["steps"]:
+                self.data["steps"].append([step, item])
+                self._save()
+
+    def discard(self, remove_staged=False):
+        """Remove the journal, and with remove_staged its staged tree."""
+        if remove_staged and self.staged:
+            shutil.rmtree(self.staged, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        if self.lock_fd is not None and os.path.exists(self.lock_path):
+            os.unlink(self.lock_path)
+        self.close()
+
+    def close(self):
+        """Release the lock, keeping the journal for a later run."""
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+    def _save(self):
+        dirname = os.path.dirname(self.path)
+        makedirs(dirname)
+        fd, tmpfile = tempfile.mkstemp(dir=dirname, prefix=".journal")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(self.data, fp, indent=2, sort_keys=True)
+        os.rename(tmpfile, self.path)
+
+
+def remove_journal(path, remove_staged=False):
+    """Remove the journal at path unless a process holds its lock.
+
+    With remove_staged the tree the journal staged is removed too.
+    Returns True if the journal was removed.
+    """
+    lock_path = os.path.splitext(path)[0] + ".lock"
+    fd = _lock_file(lock_path)
+    if fd is None:
+        return False
+    try:
+        staged = None
+        if os.path.exists(path):
+            try:
+                with open(path) as fp:
+                    staged = json.load(fp).get("staged")
+            except (IOError, ValueError):
+                pass
+            os.unlink(path)
+        if remove_staged and staged:
+            shutil.rmtree(staged, ignore_errors=True)
+        os.unlink(lock_path)
+    finally:
+        os.close(fd)
+    return True
+
+
+def find_orphans(max_age, directory=None, tmpdir=None):
+    """Return the journals and staging directories that can be removed.
+
+    Journals that no process holds and that were last opened more than
+    max_age seconds ago are orphaned, as are staging directories that no
+    journal refers to (and that are older than max_age, in case a
+    promotion is just starting). The staged tree of an orphaned journal
+    is only listed with the journal; remove it with remove_journal.
+    Returns a tuple of lists (journals, directories).
+    """
+    directory = directory or journal_dir()
+    tmpdir = tmpdir or get_config().paths().getpath('repotemp', '/var/tmp')
+    now = time.time()
+    journals, referenced = [], set()
+    if os.path.isdir(directory):
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(directory, name)
+            in_use = _is_locked(os.path.splitext(path)[0] + ".lock")
+            try:
+                with open(path) as fp:
+                    data = json.load(fp)
+            except (IOError, ValueError):
+                if not in_use:
+                    journals.append(path)
+                continue
+            if not in_use and now - data.get("created", 0) > max_age:
+                journals.append(path)
+            if data.get("staged"):
+                referenced.add(os.path.realpath(data["staged"]))
+    dirs = []
+    if os.path.isdir(tmpdir):
+        for name in sorted(os.listdir(tmpdir)):
+            path = os.path.join(tmpdir, name)
+            if (name.startswith(STAGING_PREFIX) and os.path.isdir(path) and
+                    os.path.realpath(path) not in referenced and
+                    now - os.path.getmtime(path) > max_age):
+                dirs.append(path)
+    return journals, dirs
@@ -0,0 +1,214 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+import fnmatch
+import os
+import stat
+
+from .rpmfile import package_digests
+from .utils import parallel_map, walkerror
+
+
+def find_repo_dirs(toplevel):
+    """Return the repository directories under toplevel.
+
+    A directory is a repository if it has metadata or, failing that,
+    packages of its own. Symlinked directories, which are aliases of
+    another distro or release, are not followed.
+    """
+    repo_dirs = []
+    for dirpath, dirs, files in os.walk(toplevel, onerror=walkerror):
+        if "repodata" in dirs or fnmatch.filter(files, "*.rpm"):
+            repo_dirs.append(dirpath)
+            del dirs[:]
+        else:
+            dirs.sort()
+    return repo_dirs
+
+
+class ManifestEntry(object):
+    """A file in a repository tree.
+
+    sha256 is the digest of the file and content the digest of the
+    package without its signature (see rpmfile.package_digests); both
+    are None until the entry has been digested.
+    """
+
+    def __init__(self, name, size, mtime, sha256=None, content=None):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.sha256 = sha256
+        self.content = content
+
+    def to_dict(self):
+        return {"name": self.name, "size": self.size, "mtime": self.mtime,
+                "sha256": self.sha256}
+
+
+class Manifest(object):
+    """The regular files of a repository tree, keyed by relative path.
+
+    Repository metadata is left out; the directories that carry it are
+    listed in repo_dirs. Symlinks are listed in links, and symlinks to
+    files also have an entry describing their target.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.entries = {}
+        self.dirs = []
+        self.repo_dirs = []
+        self.links = set()
+
+    @classmethod
+    def scan(cls, root):
+        """Build a manifest of root from a single walk, without digests."""
+        manifest = cls(root)
+        if root is None or not os.path.isdir(root):
+            return manifest
+        for dirpath, dirs, files in os.walk(root, onerror=walkerror):
+            reldir = os.path.relpath(dirpath, root)
+            if reldir == ".":
+                reldir = ""
+            if "repodata" in dirs:
+                dirs.remove("repodata")
+                manifest.repo_dirs.append(reldir)
+            for d in dirs:
+                if os.path.islink(os.path.join(dirpath, d)):
+                    manifest.links.add(os.path.join(reldir, d))
+            manifest.dirs.append(reldir)
+            for f in files:
+                name = os.path.join(reldir, f)
+                filename = os.path.join(dirpath, f)
+                if os.path.islink(filename):
+                    manifest.links.add(name)
+                try:
+                    st = os.stat(filename)
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    manifest.entries[name] = ManifestEntry(name, st.st_size,
+                                                           int(st.st_mtime))
+        return manifest
+
+    def digest(self, names=None, workers=1, cache=None):
+        """Fill in the digests of names (default all entries).
+
+        Packages are looked up in cache, a HeaderCache, when given.
+        """
+        if names is None:
+            names = self.entries.keys()
+        entries = [self.entries[name] for name in names
+                   if self.entries[name].sha256 is None]
+        if cache is not None:
+            packages = [self.path(entry.name) for entry in entries
+                        if entry.name.endswith(".rpm")]
+            infos = cache.get_many(packages, workers)
+            for entry in entries:
+                info = infos.get(self.path(entry.name))
+                if info is not None:
+                    entry.sha256, entry.content = info.sha256, info.content
+            entries = [entry for entry in entries if entry.sha256 is None]
+
+        def _digest(entry):
+            return package_digests(os.path.join(self.root, entry.name))
+
+        for entry, digests in zip(entries, parallel_map(_digest, entries, workers)):
+            entry.sha256, entry.content = digests
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __getitem__(self, name):
+        return self.entries[name]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class MergePlan(object):
+    """The files to add, replace and skip when merging source into dest.
+
+    A file is replaced when its content differs from the file of the same
+    name in dest; signatures are ignored, so a signed copy of an unchanged
+    package is skipped.
+    """
+
+    def __init__(self, source, dest):
+        self.source = source
+        self.dest = dest
+        self.add = []
+        self.replace = []
+        self.skip = []
+        self.links = []
+
+    @classmethod
+    def build(cls, source_root, dest_root, workers=1, cache=None):
+        source = Manifest.scan(source_root)
+        dest = Manifest.scan(dest_root)
+        source.digest(workers=workers, cache=cache)
+        dest.digest([name for name in source.entries if name in dest],
+                    workers, cache)
+        plan = cls(source, dest)
+        for name in sorted(source.entries):
+            if name in dest.links:
+                plan.links.append(name)
+            elif name not in dest:
+                plan.add.append(name)
+            elif dest[name].content != source[name].content:
+                plan.replace.append(name)
+            else:
+                plan.skip.append(name)
+        return plan
+
+    @property
+    def copies(self):
+        return self.add + self.replace
+
+    @property
+    def copy_bytes(self):
+        return sum(self.source[name].size for name in self.copies)
+
+    def report(self):
+        lines = []
+        for action, names in (("add", self.add), ("replace", self.replace),
+                              ("skip", self.skip)):
+            for name in names:
+                lines.append("{0} {1}".format(action, name))
+        lines.append("{0} to add, {1} to replace, {2} unchanged; {3:.1f} MB to copy".format(
+            len(self.add), len(self.replace), len(self.skip),
+            self.copy_bytes / (1024.0 * 1024.0)))
+        return "\n".join(lines)
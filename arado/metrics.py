@@ -0,0 +1,305 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+"""Timings and counts recorded while arado runs.
+
+Work is recorded as spans: a named, labelled stretch of wall time with
+counters such as files and bytes attached. The subprocesses run inside
+a span are timed and added to it, including those run by worker threads
+started within(...) the span. At the end of a run the recorder is
+written out as JSON, as a Prometheus textfile-collector file, or both.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+__all__ = ['get_recorder', 'span', 'command', 'count', 'current_spans',
+           'within', 'record_span']
+
+
+class Span(object):
+    def __init__(self, name, labels):
+        self.name = name
+        self.labels = labels
+        self.counters = {}
+        self.subprocess_seconds = 0.0
+        self.started = time.time()
+        self.elapsed = None
+        self.failed = False
+
+    def add(self, **counters):
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def to_dict(self):
+        return {"name": self.name,
+                "labels": self.labels,
+                "started": self.started,
+                "elapsed": self.elapsed,
+                "subprocess_seconds": self.subprocess_seconds,
+                "counters": self.counters,
+                "failed": self.failed}
+
+
+class Recorder(object):
+    """Collects spans, command timings and counters from every thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.spans = []
+        # command name -> [runs, seconds]
+        self.commands = {}
+        self.counters = {}
+
+    def _stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    @contextmanager
+    def span(self, name, **labels):
+        current = Span(name, labels)
+        stack = self._stack()
+        stack.append(current)
+        try:
+            yield current
+        except:
+            current.failed = True
+            raise
+        finally:
+            stack.pop()
+            current.elapsed = time.time() - current.started
+            with self.lock:
+                self.spans.append(current)
+
+    def current_spans(self):
+        """Return the open spans of this thread, innermost last."""
+        return list(self._stack())
+
+    @contextmanager
+    def within(self, spans):
+        """Nest this thread's spans and subprocesses in spans.
+
+        spans are the current_spans() of the thread that started this
+        one, so work done by its workers is charged to them.
+        """
+        stack = self._stack()
+        saved = stack[:]
+        stack[:] = list(spans) + saved
+        try:
+            yield
+        finally:
+            stack[:] = saved
+
+    def record_span(self, name, elapsed, counters=None, **labels):
+        """Record a span timed by the caller, e.g. summed over threads."""
+        current = Span(name, labels)
+        current.started = time.time() - elapsed
+        current.elapsed = elapsed
+        current.add(**(counters or {}))
+        with self.lock:
+            self.spans.append(current)
+
+    @contextmanager
+    def command(self, cmd):
+        """Time a subprocess, charging it to the spans of this thread."""
+        if isinstance(cmd, (list, tuple)):
+            cmd = cmd[0]
+        name = os.path.basename(cmd.split()[0]) if cmd.strip() else cmd
+        started = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - started
+            with self.lock:
+                # Spans may be shared with other threads, see within()
+                for current in self._stack():
+                    current.subprocess_seconds += elapsed
+                runs = self.commands.setdefault(name, [0, 0.0])
+                runs[0] += 1
+                runs[1] += elapsed
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self, success=None):
+        with self.lock:
+            return {"started": self.started,
+                    "elapsed": time.time() - self.started,
+                    "success": success,
+                    "spans": [s.to_dict() for s in self.spans],
+                    "commands": dict((name, {"runs": runs, "seconds": seconds})
+                                     for name, (runs, seconds)
+                                     in self.commands.items()),
+                    "counters": dict(self.counters)}
+
+    def to_prometheus(self, success=None, subcommand=None):
+        """Return the recorded metrics in the Prometheus text format.
+
+        Spans with the same name and labels are summed. Every sample is
+        labelled with subcommand, if given; a job label would clash with
+        the one Prometheus adds when scraping the textfile collector.
+        """
+        data = self.to_dict(success)
+        totals = {}
+        for s in data["spans"]:
+            labels = dict(s["labels"], stage=s["name"])
+            key = tuple(sorted(labels.items()))
+            total = totals.setdefault(key, {"seconds": 0.0, "count": 0,
+                                            "subprocess_seconds": 0.0,
+                                            "counters": {}})
+            total["seconds"] += s["elapsed"]
+            total["count"] += 1
+            total["subprocess_seconds"] += s["subprocess_seconds"]
+            for name, value in s["counters"].items():
+                total["counters"][name] = total["counters"].get(name, 0) + value
+
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append("# HELP {0} {1}".format(name, help))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+            for labels, value in samples:
+                labels = dict(labels)
+                if subcommand:
+                    labels["subcommand"] = subcommand
+                labels = ",".join('{0}="{1}"'.format(key, _escape(labels[key]))
+                                  for key in sorted(labels))
+                lines.append("{0}{1} {2}".format(
+                    name, "{" + labels + "}" if labels else "", _number(value)))
+
+        metric("arado_run_seconds", "gauge", "Wall time of the last run.",
+               [({}, data["elapsed"])])
+        metric("arado_run_timestamp_seconds", "gauge",
+               "When the last run finished.", [({}, time.time())])
+        if success is not None:
+            metric("arado_run_success", "gauge",
+                   "Whether the last run succeeded.", [({}, int(success))])
+        metric("arado_stage_seconds", "gauge", "Wall time spent in each stage.",
+               [(key, t["seconds"]) for key, t in sorted(totals.items())])
+        metric("arado_stage_runs", "gauge", "Number of times each stage ran.",
+               [(key, t["count"]) for key, t in sorted(totals.items())])
+        metric("arado_stage_subprocess_seconds", "gauge",
+               "Time each stage spent waiting on subprocesses.",
+               [(key, t["subprocess_seconds"]) for key, t in sorted(totals.items())])
+        names = sorted(set(name for t in totals.values() for name in t["counters"]))
+        for name in names:
+            metric("arado_stage_{0}".format(name), "gauge",
+                   "Number of {0} handled by each stage.".format(name),
+                   [(key, t["counters"][name]) for key, t in sorted(totals.items())
+                    if name in t["counters"]])
+        metric("arado_command_seconds", "gauge",
+               "Time spent running each external command.",
+               [({"command": name}, c["seconds"])
+                for name, c in sorted(data["commands"].items())])
+        metric("arado_command_runs", "gauge",
+               "Number of times each external command ran.",
+               [({"command": name}, c["runs"])
+                for name, c in sorted(data["commands"].items())])
+        for name, value in sorted(data["counters"].items()):
+            metric("arado_{0}".format(name), "gauge",
+                   "Count of {0}.".format(name.replace("_", " ")), [({}, value)])
+        return "\n".join(lines) + "\n"
+
+    def write_json(self, path, success=None):
+        _write_atomic(path, json.dumps(self.to_dict(success), indent=2,
+                                       sort_keys=True) + "\n")
+
+    def write_prometheus(self, path, success=None, subcommand=None):
+        _write_atomic(path, self.to_prometheus(success, subcommand))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def _write_atomic(path, data):
+    # The textfile collector may read at any time, so never leave a
+    # partly written file in its place
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmpfile = tempfile.mkstemp(dir=dirname, prefix="." + os.path.basename(path))
+    try:
+        with os.fdopen(fd, "w") as fp:
+            fp.write(data)
+        os.chmod(tmpfile, 0644)
+        os.rename(tmpfile, path)
+    except:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        raise
+
+
+_recorder = Recorder()
+
+
+def get_recorder():
+    return _recorder
+
+
+def span(name, **labels):
+    """Record the wall time of a with block as a span."""
+    return _recorder.span(name, **labels)
+
+
+def command(cmd):
+    """Record the time taken by a subprocess run in a with block."""
+    return _recorder.command(cmd)
+
+
+def current_spans():
+    return _recorder.current_spans()
+
+
+def within(spans):
+    """Charge a worker thread's work to spans opened by its parent."""
+    return _recorder.within(spans)
+
+
+def record_span(name, elapsed, counters=None, **labels):
+    _recorder.record_span(name, elapsed, counters, **labels)
+
+
+def count(name, value=1):
+    _recorder.count(name, value)
@@ -0,0 +1,206 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+"""Run the copy, sign and index stages of a promotion concurrently.
+
+Files flow from the copy workers to the signing workers through a
+bounded queue, so signing starts as soon as the first packages land
+and copying slows down rather than running far ahead of it. Once every
+file of a repository directory has been copied and signed, the
+directory is handed to the index workers, which can generate its
+metadata while other directories are still being copied.
+"""
+
+import Queue
+import os
+import threading
+
+from .exception import PromotionError
+from .metrics import current_spans, within
+
+
+class Pipeline(object):
+    """A copy -> sign -> index pipeline over the files of a promotion.
+
+    copy(name) copies one file and returns the path of a package that
+    needs signing, or None. sign(root, packages) signs a batch of
+    packages in the directory root. index(group) finishes a repository
+    directory once all of its files are through the earlier stages.
+    sign may be None when nothing is to be signed.
+    """
+
+    def __init__(self, copy, index, sign=None, copy_workers=1, sign_workers=1,
+                 index_workers=1, batch_size=100, queue_size=None):
+        self.copy = copy
+        self.sign = sign
+        self.index = index
+        self.copy_workers = max(1, copy_workers)
+        self.sign_workers = max(1, sign_workers)
+        self.index_workers = max(1, index_workers)
+        self.batch_size = max(1, batch_size)
+        self.queue_size = queue_size or self.batch_size * self.sign_workers
+        self.lock = threading.Lock()
+
+    def run(self, names, groups, group_of):
+        """Copy names, then sign and index them by group.
+
+        group_of(name) returns the group (repository directory) a file
+        belongs to, or None. Every group is indexed, including those no
+        file belongs to, unless one of its files failed. Raises a
+        PromotionError once everything has run if anything failed.
+        """
+        self.remaining = dict((group, 0) for group in groups)
+        self.failures = []
+        self.failed_groups = set()
+        copy_queue = Queue.Queue()
+        sign_queue = Queue.Queue(self.queue_size)
+        index_queue = Queue.Queue()
+        for name in names:
+            group = group_of(name)
+            if group in self.remaining:
+                self.remaining[group] += 1
+            copy_queue.put((group, name))
+        for group, count in self.remaining.items():
+            if count == 0:
+                index_queue.put(group)
+
+        def _copy_worker():
+            while True:
+                try:
+                    group, name = copy_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    package = self.copy(name)
+                except Exception as err:
+                    self._fail(group, "copying {0} failed: {1}".format(name, err))
+                    self._done(group, index_queue)
+                    continue
+                if package and self.sign:
+                    # Blocks while the signing workers catch up
+                    sign_queue.put((group, package))
+                else:
+                    self._done(group, index_queue)
+
+        def _sign_worker():
+            finished = False
+            while not finished:
+                item = sign_queue.get()
+                if item is None:
+                    return
+                batch = [item]
+                while len(batch) < self.batch_size:
+                    try:
+                        item = sign_queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if item is None:
+                        finished = True
+                        break
+                    batch.append(item)
+                self._sign_batch(batch, index_queue)
+
+        def _index_worker():
+            while True:
+                group = index_queue.get()
+                if group is None:
+                    return
+                if group in self.failed_groups:
+                    print("Error: skipping {0}; some of its files failed".format(group))
+                    continue
+                try:
+                    self.index(group)
+                except Exception as err:
+                    self._fail(group, "{0}: {1}".format(group, err))
+
+        # Work done by the workers counts towards the caller's spans
+        spans = current_spans()
+        index_threads = _start(_index_worker, self.index_workers, spans)
+        sign_threads = (_start(_sign_worker, self.sign_workers, spans)
+                        if self.sign else [])
+        _join(_start(_copy_worker, self.copy_workers, spans))
+        for thread in sign_threads:
+            sign_queue.put(None)
+        _join(sign_threads)
+        for thread in index_threads:
+            index_queue.put(None)
+        _join(index_threads)
+
+        if self.failures:
+            for message in self.failures:
+                print("Error: {0}".format(message))
+            raise PromotionError("{0} step(s) of the promotion failed".format(
+                len(self.failures)))
+
+    def _sign_batch(self, batch, index_queue):
+        by_root = {}
+        for group, package in batch:
+            root, name = os.path.split(package)
+            by_root.setdefault(root, []).append((group, name))
+        for root, items in by_root.items():
+            try:
+                self.sign(root, [name for group, name in items])
+            except Exception as err:
+                for group in set(group for group, name in items):
+                    self._fail(group, "signing in {0} failed: {1}".format(root, err))
+            for group, name in items:
+                self._done(group, index_queue)
+
+    def _fail(self, group, message):
+        with self.lock:
+            self.failures.append(message)
+            self.failed_groups.add(group)
+
+    def _done(self, group, index_queue):
+        with self.lock:
+            if group not in self.remaining:
+                return
+            self.remaining[group] -= 1
+            if self.remaining[group] == 0:
+                index_queue.put(group)
+
+
+def _start(target, count, spans=()):
+    def _run():
+        with within(spans):
+            target()
+
+    threads = [threading.Thread(target=_run) for i in range(count)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    return threads
+
+
+def _join(threads):
+    for thread in threads:
+        thread.join()
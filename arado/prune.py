@@ -0,0 +1,113 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+import fnmatch
+import os
+
+from .manifest import find_repo_dirs
+from .rpmfile import compare_evr
+from .utils import walkerror
+
+
+class PrunePlan(object):
+    """The packages of a repository tree to keep and to remove.
+
+    Each repository (see manifest.find_repo_dirs) is pruned separately,
+    including packages in its subdirectories. Within a repository the
+    packages are grouped by name and arch, and the files of the newest
+    keep versions (by epoch, version and release) of each are kept.
+    Paths are relative to root. Files that cannot be read as RPMs are
+    always kept.
+    """
+
+    def __init__(self, root, keep):
+        self.root = root
+        self.keep = keep
+        self.kept = []
+        self.remove = []
+        self.sizes = {}
+        # Relative path of each package -> its repository directory
+        self.repos = {}
+
+    @classmethod
+    def build(cls, root, keep, cache, workers=1):
+        if keep < 1:
+            raise ValueError("must keep at least one version of each package")
+        plan = cls(root, keep)
+        filenames = []
+        for repo_dir in find_repo_dirs(root):
+            reldir = os.path.relpath(repo_dir, root)
+            reldir = "" if reldir == "." else reldir
+            for dirpath, dirs, files in os.walk(repo_dir, onerror=walkerror):
+                if "repodata" in dirs:
+                    dirs.remove("repodata")
+                for name in fnmatch.filter(files, "*.rpm"):
+                    filename = os.path.join(dirpath, name)
+                    if not os.path.islink(filename):
+                        filenames.append(filename)
+                        plan.repos[os.path.relpath(filename, root)] = reldir
+        infos = cache.get_many(filenames, workers)
+        # (repository, name, arch) -> {evr: [relative paths]}
+        groups = {}
+        for filename, info in infos.items():
+            relpath = os.path.relpath(filename, root)
+            key = (plan.repos[relpath], info.name, info.arch)
+            groups.setdefault(key, {}).setdefault(info.evr_tuple, []).append(relpath)
+            plan.sizes[relpath] = info.size
+        for key, versions in groups.items():
+            newest = sorted(versions, cmp=compare_evr, reverse=True)
+            for i, evr in enumerate(newest):
+                if i < keep:
+                    plan.kept.extend(versions[evr])
+                else:
+                    plan.remove.extend(versions[evr])
+        plan.kept.extend(os.path.relpath(filename, root)
+                         for filename in filenames if filename not in infos)
+        plan.kept.sort()
+        plan.remove.sort()
+        return plan
+
+    @property
+    def repo_dirs(self):
+        """The directories losing packages, whose metadata must be rebuilt."""
+        return sorted(set(self.repos[name] for name in self.remove))
+
+    @property
+    def remove_bytes(self):
+        return sum(self.sizes[name] for name in self.remove)
+
+    def report(self):
+        lines = ["remove {0}".format(name) for name in self.remove]
+        lines.append("{0} to remove, {1} kept; {2:.1f} MB to reclaim".format(
+            len(self.remove), len(self.kept),
+            self.remove_bytes / (1024.0 * 1024.0)))
+        return "\n".join(lines)
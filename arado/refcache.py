@@ -0,0 +1,171 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+from .config import get_config
+from .utils import makedirs
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS refs (
+    api TEXT NOT NULL,
+    url TEXT NOT NULL,
+    ref TEXT NOT NULL,
+    repository TEXT NOT NULL,
+    packages TEXT,
+    fetched REAL NOT NULL,
+    PRIMARY KEY (api, url, ref)
+)
+"""
+
+FULL_SHA_RE = re.compile(r'^[0-9a-fA-F]{40}$')
+
+
+def is_immutable(ref):
+    """A full commit hash always resolves to the same build."""
+    return bool(FULL_SHA_RE.match(ref or ""))
+
+
+class RefCache(object):
+    """A persistent cache of build API lookups.
+
+    Entries are keyed by (api url and target, project url, ref) and hold
+    the build repository URL and, once listed, its packages. Entries for full
+    commit hashes never expire; branches and tags expire after ttl
+    seconds. The database is opened on first use and its connection is
+    shared by all threads. A cache that cannot be opened, read or
+    written behaves as a cache that misses.
+    """
+
+    def __init__(self, path, ttl=300):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = None
+        self.failed = False
+
+    def _connect(self):
+        if self.db is None and not self.failed:
+            try:
+                if os.path.dirname(self.path):
+                    makedirs(os.path.dirname(self.path))
+                self.db = sqlite3.connect(self.path, timeout=60,
+                                          check_same_thread=False)
+            except (OSError, sqlite3.Error) as err:
+                self._warn(err)
+                self.failed = True
+                return None
+            try:
+                self.db.execute(SCHEMA)
+                self.db.commit()
+            except sqlite3.Error:
+                # A read-only cache may still answer lookups
+                pass
+        return self.db
+
+    def _warn(self, err):
+        sys.stderr.write("Warning: not using API cache {0}: {1}\n".format(
+            self.path, err))
+
+    def get(self, key):
+        """Return (repository, packages) for key, or None if not cached.
+
+        packages is None if the build has not been listed yet.
+        """
+        with self.lock:
+            db = self._connect()
+            if db is None:
+                return None
+            try:
+                row = db.execute("SELECT repository, packages, fetched FROM refs "
+                                 "WHERE api=? AND url=? AND ref=?", key).fetchone()
+            except sqlite3.Error:
+                return None
+        if row is None:
+            return None
+        repository, packages, fetched = row
+        if not is_immutable(key[2]) and time.time() - fetched > self.ttl:
+            return None
+        return repository, json.loads(packages) if packages else None
+
+    def put(self, key, repository, packages=None):
+        """Store the repository for key, and its packages if given.
+
+        Packages already cached for the same repository are kept. The
+        entry is not stored if the cache cannot be written.
+        """
+        with self.lock:
+            db = self._connect()
+            if db is None:
+                return
+            try:
+                if packages is None:
+                    row = db.execute("SELECT repository, packages FROM refs "
+                                     "WHERE api=? AND url=? AND ref=?", key).fetchone()
+                    if row and row[0] == repository:
+                        packages = json.loads(row[1]) if row[1] else None
+                db.execute("INSERT OR REPLACE INTO refs VALUES (?, ?, ?, ?, ?, ?)",
+                           tuple(key) + (repository,
+                                         json.dumps(packages) if packages is not None else None,
+                                         time.time()))
+                db.commit()
+            except sqlite3.Error:
+                db.rollback()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_ref_cache():
+    """Return the RefCache configured in [paths] and [general]."""
+    config = get_config()
+    paths = config.paths()
+    path = paths.getpath('api-cache') or os.path.join(
+        paths.getpath('repotemp', '/var/tmp'), "arado-cache", "api.sqlite")
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = RefCache(path)
+        _caches[path].ttl = config.general().getint('api-cache-ttl', 300)
+        return _caches[path]
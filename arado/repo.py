@@ -33,20 +33,34 @@
 # Core libraries
 import fnmatch
 import glob
+import hashlib
 import os
+import re
 import shutil
 import stat
+import subprocess
+import sys
 from subprocess import check_call, CalledProcessError
 import tempfile
-
-# Third party libraries
-from BeautifulSoup import BeautifulSoup
+import threading
+import time
 
 # Local libraries
 from .config import get_config
-from .signing import sign_packages
-from .exception import SigningError, PromotionError
+from .signing import (SigningPool, SigningStats, find_key,
+                      inspect_packages, make_batches)
+from .exception import PromotionError
+from .headercache import get_header_cache
+from .journal import STAGING_PREFIX
+from .manifest import MergePlan, find_repo_dirs
+from .metrics import command, count, record_span, span
+from .pipeline import Pipeline
+from .prune import PrunePlan
+from .rpmfile import RPMFileError, signature_key_id
+from .store import get_store
 from .utils import CommandEnvironment as CmdEnv
+from .utils import (PrefixedOutput, TransferStats, copy_file, exchange_paths,
+                    link_or_copy, output_prefix, parallel_map, walkerror)
 
 NEW_REPO_TEMPL = {
     "dirs": [
@@ -59,73 +73,476 @@ NEW_REPO_TEMPL = {
     ]
 }
 
+STAGING_MODES = ("copy", "snapshot")
+PUBLISH_MODES = ("move", "symlink")
 
-def walkerror(error):
-    pass
+# A generation directory under a published symlink, see publish()
+GENERATION_RE = re.compile(r"/\.([^/]+)\.generations/[^/]+(?=/|$)")
 
 
-def merge(source, dest, signingkey=None):
-    config = get_config()
-    repo_dirs = []
-    # Copy only original files
-    print("Info: copying files")
-    for root, dirs, files in os.walk(source, onerror=walkerror):
-        dest_root = root.replace(source, dest)
+def plan_merge(source, dest):
+    """Return the MergePlan for merging source into dest."""
+    workers = get_config().general().getint('copy-workers', 1)
+    with span("plan") as plan_span:
+        plan = MergePlan.build(source, dest, workers, get_header_cache())
+        plan_span.add(files=len(plan.copies), bytes=plan.copy_bytes)
+    return plan
+
+
+class BuildCopier(object):
+    """Copies the files of a MergePlan into a staged repository.
+
+    Calling it with a file name copies that file and returns its size,
+    or None if a signed copy was linked from the store instead. Packages
+    copied for signing are noted so that store_signed() can add them to
+    the store once they have been signed.
+    """
+
+    def __init__(self, plan, dest, signingkey=None):
+        self.plan = plan
+        self.dest = dest
+        # Packages already signed for another repository are linked from
+        # the store; newly signed ones are added to it afterwards
+        self.store = get_store() if signingkey else None
+        self.store_key = find_key(signingkey).key_id if self.store else None
+        self.unstored = []
+        self.linked = []
+        self.stats = TransferStats()
+        if not plan.copies:
+            self.stats.stop()
+        self.lock = threading.Lock()
+
+    def prepare(self):
+        """Create the directories of the build and report the plan.
+
+        Returns the repository directories of the build under dest.
+        """
+        plan, dest = self.plan, self.dest
+        # Copy only original files
+        print("Info: copying files")
+        for reldir in plan.source.dirs:
+            dest_root = os.path.join(dest, reldir) if reldir else dest
+            if not os.path.exists(dest_root):
+                print("Info: creating directory '{0}'".format(dest_root))
+                os.mkdir(dest_root)
+            # os.chown(dest_root, config.uid, config.gid)
+            # os.chmod(dest_root, config.general().getperms('dirperms'))
+        for name in plan.links:
+            print "Info: skipping symlink {0}".format(name)
+        for name in plan.replace:
+            print("Info: replacing changed {0}".format(name))
+        print("Info: skipping {0} unchanged files".format(len(plan.skip)))
 
         # Mark directories for which we will rebuild repository metadata
-        if dest_root.endswith("/repodata"):
-            repo_dirs.append(os.path.dirname(dest_root))
-            continue
+        return [os.path.join(dest, d) if d else dest
+                for d in plan.source.repo_dirs]
 
-        if not os.path.exists(dest_root):
-            print("Info: creating directory '{0}'".format(dest_root))
-            os.mkdir(dest_root)
+    def _copy(self, name):
+        src = self.plan.source.path(name)
+        dest_file = os.path.join(self.dest, name)
+        if self.store and src.endswith(".rpm"):
+            digest = self.plan.source[name].sha256
+            if self.store.link(digest, self.store_key, dest_file):
+                print("Info: using signed {0} from store".format(name))
+                return None, None
+            return copy_file(src, dest_file), (dest_file, digest)
+        # os.chown(dest_file, config.uid, config.gid)
+        # os.chmod(dest_file, config.general().getperms('fileperms'))
+        return copy_file(src, dest_file), None
 
-        # os.chown(dest_root, config.uid, config.gid)
-        # os.chmod(dest_root, int(config.general().get('dirperms')))
+    def __call__(self, name):
+        size, pending = self._copy(name)
+        with self.lock:
+            if size is None:
+                self.linked.append(name)
+            else:
+                self.stats.add(size)
+            if pending:
+                self.unstored.append(pending)
+            if self.stats.files + len(self.linked) == len(self.plan.copies):
+                # Signing and indexing may still be running
+                self.stats.stop()
+        return size
 
-        for f in files:
-            dest_file = os.path.join(dest_root, f)
-            if os.path.islink(dest_file):
-                print "Info: skipping symlink {0}".format(f)
+    def copy_all(self, workers=1):
+        parallel_map(self, self.plan.copies, workers)
+
+    def resume(self):
+        """Take the place of copy_all() for files copied by an earlier run.
+
+        Every package of the build is noted for store_signed(), since the
+        plan of a resumed merge no longer shows what was copied.
+        """
+        self.stats.stop()
+        if self.store:
+            self.unstored = [(os.path.join(self.dest, name), entry.sha256)
+                             for name, entry in sorted(self.plan.source.entries.items())
+                             if name.endswith(".rpm")]
+
+    def report(self, copy_span):
+        if self.stats.finished is None:
+            self.stats.stop()
+        copy_span.add(files=self.stats.files, bytes=self.stats.bytes,
+                      linked=len(self.linked), skipped=len(self.plan.skip))
+        print("Info: copied {0}".format(self.stats))
+        if self.linked:
+            print("Info: linked {0} signed packages from store".format(len(self.linked)))
+
+    def store_signed(self):
+        for dest_file, digest in self.unstored:
+            try:
+                if signature_key_id(dest_file) == self.store_key:
+                    self.store.add(dest_file, digest, self.store_key)
+            except (IOError, OSError, RPMFileError) as err:
+                print("Warning: unable to store {0}: {1}".format(dest_file, err))
+
+
+def merge(source, dest, signingkey=None, origin=None, plan=None, journal=None):
+    """Copy the build at source into the staged repository dest.
+
+    The copied packages are signed with signingkey and the metadata of
+    every repository directory is rebuilt. Steps recorded in journal
+    have been done by an earlier run and are skipped; the steps that
+    complete are recorded in it.
+    """
+    config = get_config()
+    if plan is None:
+        plan = plan_merge(source, dest)
+    copier = BuildCopier(plan, dest, signingkey)
+    repo_dirs = copier.prepare()
+
+    if journal and journal.done("copied", source):
+        print("Info: files were copied by an earlier run")
+        copier.resume()
+        update_repo_dirs(dest, repo_dirs, signingkey, origin, journal)
+    elif config.general().getbool('pipeline', True):
+        with span("pipeline") as copy_span:
+            _run_pipeline(dest, plan, repo_dirs, copier, signingkey,
+                          origin, journal)
+            copier.report(copy_span)
+        if journal:
+            journal.record("copied", source)
+    else:
+        with span("copy") as copy_span:
+            copier.copy_all(config.general().getint('copy-workers', 1))
+            copier.report(copy_span)
+        if journal:
+            journal.record("copied", source)
+        # Rebuild repository metadata
+        update_repo_dirs(dest, repo_dirs, signingkey, origin, journal)
+    copier.store_signed()
+
+
+def merge_many(sources, dest, signingkey=None, origin=None, journal=None):
+    """Copy several builds into the staged repository dest.
+
+    Each build is copied in turn, then the packages are signed and the
+    metadata of every repository directory is rebuilt once. A file in
+    more than one build is taken from the last of them.
+    """
+    workers = get_config().general().getint('copy-workers', 1)
+    repo_dirs = set()
+    copiers = []
+    owners = {}
+    for source in sources:
+        plan = plan_merge(source, dest)
+        copier = BuildCopier(plan, dest, signingkey)
+        repo_dirs.update(copier.prepare())
+        for name in plan.copies:
+            if name in owners:
+                print("Warning: {0} from {1} replaces the copy from {2}".format(
+                    name, source, owners[name]))
+        for name in plan.source.entries:
+            owners[name] = source
+        if journal and journal.done("copied", source):
+            print("Info: files of {0} were copied by an earlier run".format(source))
+            copier.resume()
+        else:
+            with span("copy") as copy_span:
+                copier.copy_all(workers)
+                copier.report(copy_span)
+            if journal:
+                journal.record("copied", source)
+        copiers.append(copier)
+    update_repo_dirs(dest, sorted(repo_dirs), signingkey, origin, journal)
+    for copier in copiers:
+        copier.store_signed()
+
+
+def _target_dir(dest, reldir):
+    """Return the directory reldir of dest with symlinks under dest resolved.
+
+    Targets are named after the distro, such as centos/6/x86_64, while
+    the tree keeps them under rhel with a symlink for each alias.
+    """
+    real_dest = os.path.realpath(dest)
+    path = os.path.relpath(os.path.realpath(os.path.join(dest, reldir)), real_dest)
+    if path == os.pardir or path.startswith(os.pardir + os.sep):
+        raise PromotionError("target '{0}' is outside of {1}".format(reldir, dest))
+    return os.path.join(dest, path)
+
+
+def merge_targets(targets, dest, signingkey=None, origin=None, journal=None):
+    """Copy the builds of several targets into the staged repository dest.
+
+    targets is a list of (source, reldir) pairs, the directory of a
+    build for one distro, release and arch and the directory of dest it
+    is copied to. A noarch package in more than one target is copied
+    and signed once, then hardlinked into the other targets. The
+    metadata of the target directories is rebuilt concurrently.
+    """
+    general = get_config().general()
+    workers = general.getint('copy-workers', 1)
+    repo_dirs = []
+    copiers = []
+    # Content digest of each noarch package -> the copy the others link to
+    shared = {}
+    links = []
+    for source, reldir in targets:
+        if not os.path.isdir(source):
+            raise PromotionError("build has no directory '{0}'".format(source))
+        target_dest = _target_dir(dest, reldir)
+        if not os.path.isdir(target_dest):
+            print("Info: creating directory '{0}'".format(target_dest))
+            os.makedirs(target_dest)
+        if target_dest not in repo_dirs:
+            repo_dirs.append(target_dest)
+        plan = plan_merge(source, target_dest)
+        for name in plan.skip + plan.copies:
+            if not name.endswith(".noarch.rpm"):
                 continue
-            if os.path.exists(dest_file):
-                print "Info: skipping duplicate {0}".format(f)
+            entry = plan.source[name]
+            digest = entry.content or entry.sha256
+            dest_file = os.path.join(target_dest, name)
+            if digest not in shared:
+                shared[digest] = dest_file
+            elif shared[digest] != dest_file and name not in plan.skip:
+                links.append((shared[digest], dest_file))
+                (plan.add if name in plan.add else plan.replace).remove(name)
+        copier = BuildCopier(plan, target_dest, signingkey)
+        copier.prepare()
+        if journal and journal.done("copied", source):
+            print("Info: files of {0} were copied by an earlier run".format(reldir))
+            copier.resume()
+        else:
+            with span("copy", directory=reldir) as copy_span:
+                copier.copy_all(workers)
+                copier.report(copy_span)
+            if journal:
+                journal.record("copied", source)
+        copiers.append(copier)
+
+    # Shared packages are linked only once they are signed, since
+    # signing rewrites a package rather than changing it in place
+    if signingkey:
+        with signing_pool(signingkey) as pool:
+            parallel_map(lambda repo_dir: _sign_repo_dir(
+                             dest, repo_dir, signingkey, pool, journal),
+                         repo_dirs, general.getint('rebuild-workers', 1))
+    if links:
+        with span("link") as link_span:
+            for primary, dest_file in links:
+                link_or_copy(primary, dest_file)
+            link_span.add(files=len(links))
+        print("Info: linked {0} noarch packages shared between targets".format(len(links)))
+    update_repo_dirs(dest, repo_dirs, origin=origin, journal=journal)
+    for copier in copiers:
+        copier.store_signed()
+
+
+def _run_pipeline(dest, plan, repo_dirs, copy, signingkey=None, origin=None,
+                  journal=None):
+    """Copy, sign and index the files of plan with a Pipeline.
+
+    copy(name) copies a file and returns its size, or None if it was
+    linked from the store already signed.
+    """
+    general = get_config().general()
+    cache = get_header_cache()
+    key_id = find_key(signingkey).key_id if signingkey else None
+    pool = signing_pool(signingkey) if signingkey else None
+    reldirs = dict((os.path.relpath(d, dest), d) for d in repo_dirs)
+    # Copy time and counts of each directory, summed over the workers
+    copied = {}
+    copied_lock = threading.Lock()
+
+    def _group_of(name):
+        reldir = os.path.dirname(name)
+        while reldir not in reldirs:
+            if not reldir:
+                return None
+            reldir = os.path.dirname(reldir)
+        return reldirs[reldir]
+
+    def _copy(name):
+        started = time.time()
+        size = copy(name)
+        elapsed = time.time() - started
+        with copied_lock:
+            totals = copied.setdefault(os.path.dirname(name),
+                                       {"seconds": 0.0, "files": 0,
+                                        "bytes": 0, "linked": 0})
+            totals["seconds"] += elapsed
+            if size is None:
+                totals["linked"] += 1
             else:
-                shutil.copy2(os.path.join(root, f), dest_root)
-                # os.chown(dest_file, config.uid, config.gid)
-                # os.chmod(dest_file, int(config.general().get('fileperms')))
-    # Rebuild repository metadata
-    for repo_dir in repo_dirs:
-        if signingkey:
-            sign(repo_dir, signingkey)
-        rebuild(repo_dir)
+                totals["files"] += 1
+                totals["bytes"] += size
+        if size is not None and name.endswith(".rpm"):
+            return os.path.join(dest, name)
+        return None
 
+    def _sign(root, packages):
+        with span("sign", directory=os.path.relpath(root, dest)) as sign_span:
+            unsigned, foreign, current = inspect_packages(packages, key_id,
+                                                          root, cache)
+            pool.sign([(root, unsigned, False), (root, foreign, True)])
+            sign_span.add(signed=len(unsigned), resigned=len(foreign),
+                          skipped=len(current))
 
-def sign(repo, signingkey):
-    for root, dirs, files in os.walk(repo, onerror=walkerror):
+    def _index(repo_dir):
+        output_prefix(os.path.relpath(repo_dir, dest))
         try:
-            pkglist = []
-            for pkg in fnmatch.filter(files, "*.rpm"):
-                if not os.path.islink(os.path.join(root, pkg)):
-                    pkglist.append(pkg)
-            sign_packages(pkglist, signingkey, path=root)
-        except SigningError, e:
-            print(e)
-
-
-def stage(path, merge=False):
-    tmpdir = get_config().paths().get('repotemp', '/var/tmp')
-    path_tmp = tempfile.mkdtemp(dir=tmpdir)
+            _update_repo_dir(dest, repo_dir, signingkey, pool, origin, journal)
+        finally:
+            output_prefix(None)
+
+    pipeline = Pipeline(_copy, _index, _sign if signingkey else None,
+                        copy_workers=general.getint('copy-workers', 1),
+                        sign_workers=general.getint('sign-workers', 1),
+                        index_workers=general.getint('rebuild-workers', 1),
+                        batch_size=general.getint('sign-batch-size', 100))
+    stdout = sys.stdout
+    if pipeline.index_workers > 1 and len(repo_dirs) > 1:
+        sys.stdout = PrefixedOutput(stdout)
+    try:
+        pipeline.run(plan.copies, repo_dirs, _group_of)
+    finally:
+        sys.stdout = stdout
+        if pool:
+            pool.close()
+        for reldir, totals in sorted(copied.items()):
+            seconds = totals.pop("seconds")
+            record_span("copy", seconds, totals, directory=reldir or ".")
+
+
+def plan_prune(path, keep=None):
+    """Return the PrunePlan keeping the newest keep versions under path.
+
+    keep defaults to prune-keep in [general].
+    """
+    general = get_config().general()
+    if keep is None:
+        keep = general.getint('prune-keep', 3)
+    return PrunePlan.build(path, keep, get_header_cache(),
+                           general.getint('copy-workers', 1))
+
+
+def prune(path, keep=None, origin=None, plan=None):
+    """Remove old package versions from the repository at path.
+
+    path should be a staged repository; the metadata of the directories
+    that lost packages is rebuilt. Returns the PrunePlan carried out.
+    """
+    if plan is None:
+        plan = plan_prune(path, keep)
+    with span("prune") as prune_span:
+        for name in plan.remove:
+            print("Info: removing {0}".format(name))
+            os.unlink(os.path.join(path, name))
+        prune_span.add(files=len(plan.remove), bytes=plan.remove_bytes)
+    print("Info: removed {0} packages ({1:.1f} MB)".format(
+        len(plan.remove), plan.remove_bytes / (1024.0 * 1024.0)))
+    repo_dirs = [os.path.join(path, d) if d else path for d in plan.repo_dirs]
+    update_repo_dirs(path, repo_dirs, origin=origin)
+    return plan
+
+
+def describe(path):
+    """Return (relative path, PackageInfo) for each package under path."""
+    filenames = []
+    for root, dirs, files in os.walk(path, onerror=walkerror):
+        for pkg in fnmatch.filter(files, "*.rpm"):
+            if not os.path.islink(os.path.join(root, pkg)):
+                filenames.append(os.path.join(root, pkg))
+    workers = get_config().general().getint('copy-workers', 1)
+    infos = get_header_cache().get_many(filenames, workers)
+    return [(os.path.relpath(filename, path), infos[filename])
+            for filename in sorted(infos)]
+
+
+def signing_pool(signingkey):
+    """Create a SigningPool configured from the [general] section."""
+    config = get_config()
+    general = config.general()
+    passphrase = ''
+    passphrase_file = config.paths().getpath('sign-passphrase-file')
+    if passphrase_file:
+        with open(passphrase_file) as fp:
+            passphrase = fp.readline().rstrip("\n")
+    return SigningPool(signingkey,
+                       workers=general.getint('sign-workers', 1),
+                       passphrase=passphrase,
+                       timeout=general.getint('sign-timeout', 60),
+                       package_timeout=general.getint('sign-package-timeout', 5))
+
+
+def sign(repo, signingkey, force=False, pool=None):
+    """Sign every package under repo that is not signed by signingkey.
+
+    With force set all packages are re-signed. Batches are signed using
+    pool, or a pool created for this call. Returns SigningStats.
+    """
+    batch_size = get_config().general().getint('sign-batch-size', 100)
+    key = find_key(signingkey)
+    cache = get_header_cache()
+    stats = SigningStats()
+    batches = []
+    for root, dirs, files in os.walk(repo, onerror=walkerror):
+        pkglist = []
+        for pkg in fnmatch.filter(files, "*.rpm"):
+            if not os.path.islink(os.path.join(root, pkg)):
+                pkglist.append(pkg)
+        if force:
+            unsigned, foreign, current = [], pkglist, []
+        else:
+            unsigned, foreign, current = inspect_packages(
+                pkglist, key.key_id, root, cache)
+        for pkg in unsigned + foreign:
+            # Signing rewrites the package, so it must not share
+            # its data with the published tree
+            break_link(os.path.join(root, pkg))
+        for batch in make_batches(unsigned, batch_size):
+            batches.append((root, batch, False))
+        for batch in make_batches(foreign, batch_size):
+            batches.append((root, batch, True))
+        stats += SigningStats(len(unsigned), len(foreign), len(current))
+    if pool is None:
+        with signing_pool(signingkey) as pool:
+            pool.sign(batches)
+    else:
+        pool.sign(batches)
+    print("Info: signing {0}: {1}".format(repo, stats))
+    return stats
+
+
+def stage(path, merge=False, mode=None):
+    config = get_config()
+    tmpdir = config.paths().getpath('repotemp', '/var/tmp')
+    if mode is None:
+        mode = config.general().get('staging', 'copy')
+    if mode not in STAGING_MODES:
+        raise PromotionError("unknown staging mode '{0}'".format(mode))
+    path_tmp = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=tmpdir)
     os.chmod(path_tmp,
              stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH |
              stat.S_IXOTH | stat.S_ISGID)
     if os.path.exists(path) and merge:
-        cmd = ['cp', '-a', os.path.join(path, '.'), path_tmp]
-        try:
-            check_call(cmd)
-        except CalledProcessError as err:
-            raise PromotionError("Failed to create temporary repository with status {0}".format(err.returncode))
+        with span("stage", mode=mode):
+            if mode == "snapshot":
+                snapshot(path, path_tmp)
+            else:
+                _copy_tree(path, path_tmp)
     else:
         print("Info: creating repository template")
         for d in NEW_REPO_TEMPL["dirs"]:
@@ -135,20 +552,230 @@ def stage(path, merge=False):
     return path_tmp
 
 
-def rebuild_all(toplevel):
-    for d in NEW_REPO_TEMPL["dirs"]:
-        for arch in ("i386", "x86_64"):
-            archdir = os.path.join(toplevel, d, arch)
-            if os.path.isdir(archdir):
-                rebuild(archdir)
+def _copy_tree(path, path_tmp, opts=None, quiet=False):
+    cmd = ['cp', '-a'] + (opts or []) + [os.path.join(path, '.'), path_tmp]
+    try:
+        with command(cmd):
+            if quiet:
+                with open(os.devnull, 'w') as devnull:
+                    check_call(cmd, stderr=devnull)
+            else:
+                check_call(cmd)
+    except CalledProcessError as err:
+        raise PromotionError("Failed to create temporary repository with status {0}".format(err.returncode))
+
+
+def _clear_dir(path):
+    for name in os.listdir(path):
+        entry = os.path.join(path, name)
+        if os.path.isdir(entry) and not os.path.islink(entry):
+            shutil.rmtree(entry)
+        else:
+            os.unlink(entry)
 
 
-def rebuild(path, comps_file=None, chroot=None):
+def snapshot(path, path_tmp):
+    """Populate path_tmp with a copy-on-write snapshot of path.
+
+    Reflinks are tried first, then hardlinks (which need path and
+    path_tmp on the same filesystem); a full copy is the last resort.
+    Hardlinked files are shared with the live repository, so anything
+    that rewrites a file in place must call break_link() on it first.
+    Returns the method that was used.
+    """
+    for method, opts in (("reflink", ["--reflink=always"]),
+                         ("hardlink", ["--link"])):
+        try:
+            _copy_tree(path, path_tmp, opts, quiet=True)
+            print("Info: staged '{0}' using {1}s".format(path, method))
+            return method
+        except PromotionError:
+            _clear_dir(path_tmp)
+    print("Info: snapshot not supported for '{0}'; copying".format(path))
+    _copy_tree(path, path_tmp)
+    return "copy"
+
+
+def break_link(filename):
+    """Give a hardlinked file its own copy of its data.
+
+    Returns True if the link was broken.
+    """
+    st = os.lstat(filename)
+    if not stat.S_ISREG(st.st_mode) or st.st_nlink < 2:
+        return False
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                   prefix="." + os.path.basename(filename))
+    os.close(fd)
+    try:
+        shutil.copy2(filename, tmpfile)
+        try:
+            os.chown(tmpfile, st.st_uid, st.st_gid)
+        except OSError:
+            pass
+        os.rename(tmpfile, filename)
+    except:
+        os.unlink(tmpfile)
+        raise
+    return True
+
+
+def update_repo_dirs(toplevel, repo_dirs, signingkey=None, origin=None,
+                     journal=None):
+    """Sign and rebuild the metadata of each of repo_dirs concurrently.
+
+    Up to rebuild-workers ([general]) directories are processed at once,
+    each job's output prefixed with its directory. All directories are
+    processed, then a PromotionError is raised if any of them failed.
+    """
+    workers = get_config().general().getint('rebuild-workers', 1)
+    pool = signing_pool(signingkey) if signingkey else None
+
+    def _update(repo_dir):
+        output_prefix(os.path.relpath(repo_dir, toplevel))
+        try:
+            _update_repo_dir(toplevel, repo_dir, signingkey, pool, origin, journal)
+        except Exception as err:
+            print("Error: {0}".format(err))
+            return repo_dir, err
+        finally:
+            output_prefix(None)
+        return repo_dir, None
+
+    stdout = sys.stdout
+    if workers > 1 and len(repo_dirs) > 1:
+        sys.stdout = PrefixedOutput(stdout)
+    try:
+        results = parallel_map(_update, repo_dirs, workers)
+    finally:
+        sys.stdout = stdout
+        if pool:
+            pool.close()
+    failed = [repo_dir for repo_dir, err in results if err]
+    if failed:
+        raise PromotionError("{0} of {1} repository directories failed: {2}".format(
+            len(failed), len(results), ", ".join(failed)))
+
+
+def _update_repo_dir(toplevel, repo_dir, signingkey=None, pool=None, origin=None,
+                     journal=None):
+    """Sign the packages of repo_dir, then rebuild its metadata."""
+    reldir = os.path.relpath(repo_dir, toplevel)
+    if journal and journal.done("indexed", reldir):
+        print("Info: {0} was signed and indexed by an earlier run".format(reldir))
+        return
+    if signingkey:
+        _sign_repo_dir(toplevel, repo_dir, signingkey, pool, journal)
+    with span("rebuild", directory=reldir):
+        rebuild(repo_dir, incremental=True,
+                origin=_origin_path(origin, toplevel, repo_dir))
+    if journal:
+        journal.record("indexed", reldir)
+
+
+def _sign_repo_dir(toplevel, repo_dir, signingkey, pool=None, journal=None):
+    """Sign the packages of repo_dir unless journal records it as signed."""
+    reldir = os.path.relpath(repo_dir, toplevel)
+    if journal and journal.done("signed", reldir):
+        return
+    with span("sign", directory=reldir) as sign_span:
+        stats = sign(repo_dir, signingkey, pool=pool)
+        sign_span.add(signed=stats.signed, resigned=stats.resigned,
+                      skipped=stats.skipped)
+    if journal:
+        journal.record("signed", reldir)
+
+
+def rebuild_all(toplevel, origin=None):
+    update_repo_dirs(toplevel, find_repo_dirs(toplevel), origin=origin)
+
+
+def _origin_path(origin, toplevel, path):
+    if origin is None:
+        return None
+    return os.path.join(origin, os.path.relpath(path, toplevel))
+
+
+def metadata_cachedir(origin):
+    """Return the persistent createrepo cache directory for a repository.
+
+    origin is the published location of the repository, so the cache
+    survives across the temporary directories used for staging. Aliases
+    of the same repository, such as a distro symlink, share one cache.
+    """
+    tmpdir = get_config().paths().getpath('repotemp', '/var/tmp')
+    return os.path.join(tmpdir, "arado-cache", "createrepo",
+                        hashlib.sha1(_canonical_origin(origin)).hexdigest())
+
+
+def _canonical_origin(origin):
+    """Resolve symlinks in origin, except the flip to a generation.
+
+    A repository published as a symlink resolves to its live generation,
+    which changes with every publish, so the generation is mapped back
+    to the published name.
+    """
+    return GENERATION_RE.sub(r"/\1", os.path.realpath(origin))
+
+
+def _metadata_fingerprint(path):
+    """Hash the name, size and mtime of every file createrepo would read."""
+    entries = []
+    for root, dirs, files in os.walk(path, onerror=walkerror):
+        if "repodata" in dirs:
+            dirs.remove("repodata")
+        for f in files:
+            filename = os.path.join(root, f)
+            is_comps = root == path and f.endswith("xml")
+            is_package = (f.endswith(".rpm") and
+                          not fnmatch.fnmatch(f, "*release-internal*"))
+            if not (is_comps or is_package) or os.path.islink(filename):
+                continue
+            st = os.stat(filename)
+            entries.append("{0} {1} {2}".format(
+                os.path.relpath(filename, path), st.st_size, int(st.st_mtime)))
+    entries.sort()
+    return hashlib.sha1("\n".join(entries)).hexdigest()
+
+
+def _repomd_digest(path):
+    repomd = os.path.join(path, "repodata", "repomd.xml")
+    if not os.path.isfile(repomd):
+        return None
+    with open(repomd, "rb") as fp:
+        return hashlib.sha1(fp.read()).hexdigest()
+
+
+def rebuild(path, comps_file=None, chroot=None, incremental=False, origin=None):
+    """Run createrepo on path.
+
+    With incremental set the previous repodata is kept and createrepo is
+    run with --update and a persistent --cachedir, so only new or changed
+    packages are read. The rebuild is skipped entirely when no package
+    has changed since the metadata was last generated for origin (which
+    defaults to path).
+    """
     print("Info: createrepo on {0}".format(path))
-    cmd = ["/usr/bin/createrepo"]
+    cmd = [get_config().general().get('createrepo', '/usr/bin/createrepo')]
 
-    # Clear all repository metadata
-    shutil.rmtree(os.path.join(path, "repodata"), ignore_errors=True)
+    if incremental:
+        cachedir = metadata_cachedir(origin or path)
+        statefile = os.path.join(cachedir, "state")
+        fingerprint = _metadata_fingerprint(path)
+        repomd = _repomd_digest(path)
+        if repomd and os.path.isfile(statefile):
+            with open(statefile) as fp:
+                if fp.read().split() == [fingerprint, repomd]:
+                    print("Info: metadata for {0} is up to date; skipping".format(path))
+                    count("rebuilds_skipped")
+                    return
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        if chroot is None:
+            cmd += ["--cachedir", cachedir]
+    else:
+        # Clear all repository metadata
+        shutil.rmtree(os.path.join(path, "repodata"), ignore_errors=True)
 
     with CmdEnv(chroot=chroot, src=path) as env:
         try:
@@ -180,10 +807,174 @@ def rebuild(path, comps_file=None, chroot=None):
         print "executing command: {0}".format(cmd)
         env.call(cmd)
 
-def replace(source_path, dest_path):
-    dest_path_temp = dest_path + "-temp"
-    if os.path.exists(dest_path):
-        os.rename(dest_path, dest_path_temp)
-    shutil.move(source_path, dest_path)
-    if os.path.exists(dest_path_temp):
-        shutil.rmtree(dest_path_temp)
+    if incremental:
+        with open(statefile, "w") as fp:
+            fp.write("{0} {1}\n".format(fingerprint, _repomd_digest(path)))
+
+def replace(source_path, dest_path, mode=None):
+    """Publish the staged repository source_path at dest_path.
+
+    In "move" mode the old repository is moved aside and removed once
+    the new one is in place. In "symlink" mode, or if dest_path was
+    published as a symlink, see publish().
+    """
+    general = get_config().general()
+    if mode is None:
+        mode = general.get('publish', 'move')
+    if mode not in PUBLISH_MODES:
+        raise PromotionError("unknown publish mode '{0}'".format(mode))
+    with span("replace", mode=mode):
+        if mode == "symlink" or os.path.islink(dest_path.rstrip("/")):
+            # A repository published as a symlink stays one, so that
+            # its generations can still be rolled back
+            publish(source_path, dest_path, keep=general.getint('publish-keep', 1))
+            return
+        dest_path_temp = dest_path + "-temp"
+        # Without the parent shutil.move copies the tree, which loses
+        # the hardlinks between packages shared by several targets
+        parent = os.path.dirname(dest_path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent)
+        if os.path.exists(dest_path):
+            os.rename(dest_path, dest_path_temp)
+        shutil.move(source_path, dest_path)
+        if os.path.exists(dest_path_temp):
+            shutil.rmtree(dest_path_temp)
+
+
+def generations_dir(dest_path):
+    dest_path = dest_path.rstrip("/")
+    return os.path.join(os.path.dirname(dest_path),
+                        "." + os.path.basename(dest_path) + ".generations")
+
+
+def generations(dest_path):
+    """Return the published generations of dest_path, oldest first."""
+    gendir = generations_dir(dest_path)
+    if not os.path.isdir(gendir):
+        return []
+    return sorted(os.path.join(gendir, name) for name in os.listdir(gendir)
+                  if not name.endswith((".deleted", ".rolledback")))
+
+
+def _rolled_back(dest_path):
+    gendir = generations_dir(dest_path)
+    if not os.path.isdir(gendir):
+        return []
+    return sorted(os.path.join(gendir, name) for name in os.listdir(gendir)
+                  if name.endswith(".rolledback"))
+
+
+def current_generation(dest_path):
+    if not os.path.islink(dest_path):
+        return None
+    return os.path.join(os.path.dirname(dest_path.rstrip("/")),
+                        os.readlink(dest_path))
+
+
+def _flip(dest_path, target):
+    """Atomically point the dest_path symlink at target."""
+    dest_path = dest_path.rstrip("/")
+    link = os.path.relpath(target, os.path.dirname(dest_path))
+    tmp_link = "{0}.{1}.link".format(dest_path, os.getpid())
+    os.symlink(link, tmp_link)
+    try:
+        os.rename(tmp_link, dest_path)
+    except:
+        os.unlink(tmp_link)
+        raise
+
+
+def _convert(dest_path, target, old_generation):
+    """Replace the directory dest_path with a symlink to target.
+
+    The directory and the symlink are swapped in one step where the
+    kernel allows it; otherwise the directory is renamed aside just
+    before the symlink takes its place.
+    """
+    link = os.path.relpath(target, os.path.dirname(dest_path))
+    tmp_link = "{0}.{1}.link".format(dest_path, os.getpid())
+    os.symlink(link, tmp_link)
+    try:
+        if exchange_paths(tmp_link, dest_path):
+            os.rename(tmp_link, old_generation)
+            return
+        os.rename(dest_path, old_generation)
+        os.rename(tmp_link, dest_path)
+    except:
+        if os.path.islink(tmp_link):
+            os.unlink(tmp_link)
+        raise
+
+
+def _remove_in_background(path):
+    deleted = path + ".deleted"
+    os.rename(path, deleted)
+    subprocess.Popen(["rm", "-rf", deleted], close_fds=True)
+
+
+def publish(source_path, dest_path, keep=1):
+    """Publish source_path as a new generation of dest_path.
+
+    dest_path is a symlink into a hidden generations directory next to
+    it, and is switched to the new generation with a single rename(2),
+    so clients always see a complete repository. The keep newest old
+    generations are retained for rollback(), along with the generation
+    that was live before this one; older ones, and those a rollback
+    left behind, are removed in the background.
+    """
+    dest_path = dest_path.rstrip("/")
+    gendir = generations_dir(dest_path)
+    if not os.path.isdir(gendir):
+        os.makedirs(gendir)
+    now = time.time()
+    generation = os.path.join(gendir, "{0}.{1:06d}".format(
+        time.strftime("%Y%m%d%H%M%S", time.gmtime(now)),
+        int(now % 1 * 1000000)))
+    while os.path.exists(generation):
+        generation += "-"
+
+    shutil.move(source_path, generation)
+    os.chmod(generation, os.stat(generation).st_mode | stat.S_IROTH | stat.S_IXOTH)
+    previous = current_generation(dest_path)
+    if os.path.isdir(dest_path) and not os.path.islink(dest_path):
+        # First symlink publish of an existing repository: keep the old
+        # tree as the oldest generation
+        print("Info: converting '{0}' to a published symlink".format(dest_path))
+        previous = os.path.join(gendir, "00000000000000.000000")
+        _convert(dest_path, generation, previous)
+    else:
+        _flip(dest_path, generation)
+    print("Info: published '{0}' as {1}".format(dest_path,
+                                                os.path.basename(generation)))
+
+    old = [gen for gen in generations(dest_path) if gen != generation]
+    for gen in old[:max(0, len(old) - keep)]:
+        if previous and os.path.realpath(gen) == os.path.realpath(previous):
+            continue
+        print("Info: removing old generation {0}".format(os.path.basename(gen)))
+        _remove_in_background(gen)
+    for gen in _rolled_back(dest_path):
+        _remove_in_background(gen)
+
+
+def rollback(dest_path):
+    """Point dest_path back at the generation before the current one.
+
+    The generations newer than the restored one are set aside, so later
+    publishes and rollbacks never return to them; the next publish
+    removes them.
+    """
+    current = current_generation(dest_path)
+    if current is None:
+        raise PromotionError("'{0}' is not a published symlink".format(dest_path))
+    older = [gen for gen in generations(dest_path) if gen < current]
+    if not older:
+        raise PromotionError("no older generation of '{0}'".format(dest_path))
+    _flip(dest_path, older[-1])
+    print("Info: rolled back '{0}' to {1}".format(dest_path,
+                                                  os.path.basename(older[-1])))
+    for gen in generations(dest_path):
+        if gen > older[-1]:
+            os.rename(gen, gen + ".rolledback")
+    return older[-1]
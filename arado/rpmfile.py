@@ -0,0 +1,324 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+import hashlib
+import os
+import re
+import struct
+from collections import namedtuple
+
+from .exception import AradoException
+
+LEAD_SIZE = 96
+LEAD_MAGIC = "\xed\xab\xee\xdb"
+HEADER_MAGIC = "\x8e\xad\xe8\x01"
+
+# Signature header tags, most complete signature first
+SIGTAG_PGP = 1002
+SIGTAG_GPG = 1005
+SIGTAG_RSA = 268
+SIGTAG_DSA = 267
+SIGNATURE_TAGS = (SIGTAG_PGP, SIGTAG_GPG, SIGTAG_RSA, SIGTAG_DSA)
+
+# Main header tags
+RPMTAG_NAME = 1000
+RPMTAG_VERSION = 1001
+RPMTAG_RELEASE = 1002
+RPMTAG_EPOCH = 1003
+RPMTAG_ARCH = 1022
+RPMTAG_SOURCERPM = 1044
+
+RPM_INT32_TYPE = 4
+RPM_STRING_TYPE = 6
+
+# OpenPGP signature subpackets carrying the issuer
+SUBPACKET_ISSUER = 16
+SUBPACKET_ISSUER_FPR = 33
+
+
+class RPMFileError(AradoException):
+    """Class for errors reading an RPM file."""
+
+
+class PackageInfo(namedtuple("PackageInfo", "name epoch version release arch "
+                             "sha256 content sigkey size")):
+    """What arado needs to know about an RPM file.
+
+    sha256 and content are the digests from package_digests(), sigkey
+    the long ID of the signing key (or None) and size the file size.
+    """
+    __slots__ = ()
+
+    @property
+    def evr(self):
+        if self.epoch:
+            return "{0}:{1}-{2}".format(self.epoch, self.version, self.release)
+        return "{0}-{1}".format(self.version, self.release)
+
+    @property
+    def nevra(self):
+        return "{0}-{1}.{2}".format(self.name, self.evr, self.arch)
+
+    @property
+    def evr_tuple(self):
+        return (self.epoch, self.version, self.release)
+
+
+_VERSION_SEGMENT_RE = re.compile(r"~|\^|[0-9]+|[a-zA-Z]+")
+
+
+def rpmvercmp(a, b):
+    """Compare two version or release strings the way rpm does.
+
+    Returns a negative number, zero or a positive number when a is
+    older than, the same as or newer than b.
+    """
+    if a == b:
+        return 0
+    a_segs = _VERSION_SEGMENT_RE.findall(a or "")
+    b_segs = _VERSION_SEGMENT_RE.findall(b or "")
+    while True:
+        x = a_segs.pop(0) if a_segs else None
+        y = b_segs.pop(0) if b_segs else None
+        # A tilde sorts before anything, even the end of the version
+        if x == "~" or y == "~":
+            if x != "~":
+                return 1
+            if y != "~":
+                return -1
+            continue
+        # A caret sorts after the end of the version but before the rest
+        if x == "^" or y == "^":
+            if x is None:
+                return -1
+            if y is None:
+                return 1
+            if x != "^":
+                return 1
+            if y != "^":
+                return -1
+            continue
+        if x is None or y is None:
+            break
+        if x.isdigit() != y.isdigit():
+            # Numeric segments are newer than alphabetic ones
+            return 1 if x.isdigit() else -1
+        if x.isdigit():
+            x, y = x.lstrip("0"), y.lstrip("0")
+            if len(x) != len(y):
+                return cmp(len(x), len(y))
+        if x != y:
+            return cmp(x, y)
+    if x is None and y is None:
+        return 0
+    return -1 if x is None else 1
+
+
+def compare_evr(a, b):
+    """Compare two (epoch, version, release) tuples the way rpm does."""
+    result = cmp(int(a[0] or 0), int(b[0] or 0))
+    if result == 0:
+        result = rpmvercmp(a[1], b[1])
+    if result == 0:
+        result = rpmvercmp(a[2], b[2])
+    return result
+
+
+def _read_exact(fp, size):
+    data = fp.read(size)
+    if len(data) != size:
+        raise RPMFileError("unexpected end of file")
+    return data
+
+
+def _read_header(fp):
+    """Read a header structure and return a dict of tag to raw data.
+
+    Each value is a (type, count, data) tuple where data runs from the
+    entry's offset to the end of the data store.
+    """
+    intro = _read_exact(fp, 16)
+    if intro[:4] != HEADER_MAGIC:
+        raise RPMFileError("bad header magic")
+    nindex, hsize = struct.unpack(">II", intro[8:])
+    index = _read_exact(fp, nindex * 16)
+    store = _read_exact(fp, hsize)
+    tags = {}
+    for i in range(nindex):
+        tag, type_, offset, count = struct.unpack(">IIII", index[i * 16:(i + 1) * 16])
+        tags[tag] = (type_, count, store[offset:])
+    return tags, 16 + len(index) + hsize
+
+
+def read_signature_header(fp):
+    """Read the lead and signature header from an open RPM file.
+
+    The file is left positioned at the start of the main header.
+    """
+    lead = _read_exact(fp, LEAD_SIZE)
+    if lead[:4] != LEAD_MAGIC:
+        raise RPMFileError("not an RPM file")
+    tags, size = _read_header(fp)
+    # The signature header is padded to a multiple of 8 bytes
+    _read_exact(fp, (8 - size % 8) % 8)
+    return tags
+
+
+def _new_length(data, pos):
+    """Decode an OpenPGP new-format length, returning (length, pos)."""
+    first = ord(data[pos])
+    if first < 192:
+        return first, pos + 1
+    elif first < 224:
+        return ((first - 192) << 8) + ord(data[pos + 1]) + 192, pos + 2
+    elif first == 255:
+        return struct.unpack(">I", data[pos + 1:pos + 5])[0], pos + 5
+    raise RPMFileError("partial body lengths are not supported")
+
+
+def _subpacket_issuer(data):
+    pos = 0
+    while pos < len(data):
+        length, pos = _new_length(data, pos)
+        subtype = ord(data[pos]) & 0x7f
+        body = data[pos + 1:pos + length]
+        if subtype == SUBPACKET_ISSUER and len(body) >= 8:
+            return body[:8]
+        elif subtype == SUBPACKET_ISSUER_FPR and len(body) >= 9:
+            return body[-8:]
+        pos += length
+    return None
+
+
+def pgp_signature_key_id(packet):
+    """Return the issuer key ID of an OpenPGP signature packet."""
+    try:
+        ctb = ord(packet[0])
+        if ctb & 0x40:
+            tag = ctb & 0x3f
+            length, pos = _new_length(packet, 1)
+        else:
+            tag = (ctb >> 2) & 0xf
+            lensize = (1, 2, 4, 0)[ctb & 3]
+            pos = 1 + lensize
+        if tag != 2:
+            raise RPMFileError("not a signature packet")
+        body = packet[pos:]
+        version = ord(body[0])
+        if version == 3:
+            key_id = body[7:15]
+        elif version == 4:
+            hashed_len = struct.unpack(">H", body[4:6])[0]
+            hashed = body[6:6 + hashed_len]
+            pos = 6 + hashed_len
+            unhashed_len = struct.unpack(">H", body[pos:pos + 2])[0]
+            unhashed = body[pos + 2:pos + 2 + unhashed_len]
+            key_id = _subpacket_issuer(hashed) or _subpacket_issuer(unhashed)
+        else:
+            raise RPMFileError("unsupported signature version {0}".format(version))
+    except (IndexError, struct.error):
+        raise RPMFileError("truncated signature packet")
+    if not key_id or len(key_id) != 8:
+        return None
+    return key_id.encode("hex").upper()
+
+
+def _signature_key_id(tags):
+    for tag in SIGNATURE_TAGS:
+        if tag in tags:
+            type_, count, data = tags[tag]
+            return pgp_signature_key_id(data[:count])
+    return None
+
+
+def signature_key_id(filename):
+    """Return the long ID of the key that signed an RPM, or None."""
+    with open(filename, "rb") as fp:
+        return _signature_key_id(read_signature_header(fp))
+
+
+def _tag_value(tags, tag):
+    if tag not in tags:
+        return None
+    type_, count, data = tags[tag]
+    if type_ == RPM_INT32_TYPE:
+        return struct.unpack(">i", data[:4])[0]
+    elif type_ == RPM_STRING_TYPE:
+        return data[:data.find("\0")] if "\0" in data else data
+    raise RPMFileError("unsupported type {0} for tag {1}".format(type_, tag))
+
+
+def read_package(filename):
+    """Read the headers and digests of an RPM into a PackageInfo."""
+    with open(filename, "rb") as fp:
+        sigtags = read_signature_header(fp)
+        tags, _ = _read_header(fp)
+    epoch = _tag_value(tags, RPMTAG_EPOCH)
+    arch = _tag_value(tags, RPMTAG_ARCH)
+    if RPMTAG_SOURCERPM not in tags:
+        arch = "src"
+    sha256, content = package_digests(filename)
+    return PackageInfo(name=_tag_value(tags, RPMTAG_NAME),
+                       epoch=str(epoch) if epoch is not None else None,
+                       version=_tag_value(tags, RPMTAG_VERSION),
+                       release=_tag_value(tags, RPMTAG_RELEASE),
+                       arch=arch,
+                       sha256=sha256,
+                       content=content,
+                       sigkey=_signature_key_id(sigtags),
+                       size=os.path.getsize(filename))
+
+
+def package_digests(filename, blocksize=1024 * 1024):
+    """Return sha256 digests of an RPM file and of its signed content.
+
+    The second digest covers everything after the signature header, so
+    it is unchanged when the package is signed or re-signed. For files
+    that are not RPMs both digests are the same.
+    """
+    file_digest = hashlib.sha256()
+    content_digest = hashlib.sha256()
+    with open(filename, "rb") as fp:
+        try:
+            read_signature_header(fp)
+            offset = fp.tell()
+        except RPMFileError:
+            offset = 0
+        fp.seek(0)
+        file_digest.update(fp.read(offset))
+        while True:
+            block = fp.read(blocksize)
+            if not block:
+                break
+            file_digest.update(block)
+            content_digest.update(block)
+    return file_digest.hexdigest(), content_digest.hexdigest()
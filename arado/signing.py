@@ -31,14 +31,18 @@
 # Author: Matt Spaulding mspaulding@eucalyptus.com
 
 import os
+import pipes
+import Queue
 import re
 import stat
 import subprocess
 import sys
-
-import pexpect
+import threading
+import time
 
 from .exception import SigningError
+from .metrics import command, current_spans, within
+from .rpmfile import RPMFileError, signature_key_id
 from .utils import CommandEnvironment as CmdEnv
 
 RPMSIGN_CMD = 'rpmsign --define "_gpg_name %s" \
@@ -46,26 +50,328 @@ RPMSIGN_CMD = 'rpmsign --define "_gpg_name %s" \
         --digest-algo=sha1 --batch --no-verbose --no-armor \
         --passphrase-fd 3 --no-secmem-warning -u \"%%{_gpg_name}\" \
         -sbo %%{__signature_filename} %%{__plaintext_filename}" \
-        --addsign %s'
+        %s %s'
+
+# Signs through the gpg-agent of a SigningPool, which holds the passphrase
+RPMSIGN_AGENT_CMD = 'rpmsign --define "_gpg_name %s" \
+        --define "__gpg_sign_cmd %%{__gpg} gpg --force-v3-sigs \
+        --digest-algo=sha1 --batch --no-verbose --no-armor --use-agent \
+        --no-secmem-warning -u \"%%{_gpg_name}\" \
+        -sbo %%{__signature_filename} %%{__plaintext_filename}" \
+        %s %s'
 
 KEY_RE = "sec.*\/\([\w]+\).*"
 
+# Seconds allowed for an rpmsign run: a fixed allowance plus an
+# allowance for each package in the batch
+SIGN_TIMEOUT = 60
+SIGN_PACKAGE_TIMEOUT = 5
+
+# Times a replaced gpg-agent is waited for to exit
+AGENT_START_ATTEMPTS = 25
+
+# Files whose modification invalidates the cached keyring
+KEYRING_FILES = ('secring.gpg', 'pubring.gpg', 'pubring.kbx',
+                 'private-keys-v1.d')
+
+
+class SigningStats(object):
+    """Counts of packages signed, re-signed and skipped."""
+
+    def __init__(self, signed=0, resigned=0, skipped=0):
+        self.signed = signed
+        self.resigned = resigned
+        self.skipped = skipped
+
+    def __iadd__(self, other):
+        self.signed += other.signed
+        self.resigned += other.resigned
+        self.skipped += other.skipped
+        return self
+
+    def __str__(self):
+        return "{0} signed, {1} resigned, {2} skipped".format(
+            self.signed, self.resigned, self.skipped)
+
+
+def key_matches(key_id, signer):
+    """Check whether signer (a long key ID) is the key named by key_id."""
+    if signer is None:
+        return False
+    key_id = key_id.upper()
+    if key_id.startswith("0X"):
+        key_id = key_id[2:]
+    return signer.upper().endswith(key_id)
+
+
+def inspect_packages(packages, key_id, path='.', cache=None):
+    """Sort packages by their current signature.
+
+    Returns a tuple of lists (unsigned, foreign, current) holding the
+    packages that are unsigned, signed by another key, and already signed
+    by key_id. Packages whose signature cannot be read count as unsigned.
+    Signatures are looked up in cache, a HeaderCache, when given.
+    """
+    infos = {}
+    if cache is not None:
+        infos = cache.get_many([os.path.join(path, pkg) for pkg in packages])
+    unsigned, foreign, current = [], [], []
+    for pkg in packages:
+        info = infos.get(os.path.join(path, pkg))
+        try:
+            if info is not None:
+                signer = info.sigkey
+            else:
+                signer = signature_key_id(os.path.join(path, pkg))
+        except (IOError, RPMFileError) as err:
+            print("Warning: unable to read signature of {0}: {1}".format(pkg, err))
+            signer = None
+        if signer is None:
+            unsigned.append(pkg)
+        elif key_matches(key_id, signer):
+            current.append(pkg)
+        else:
+            foreign.append(pkg)
+    return unsigned, foreign, current
+
+
+def sign_packages(packages, key_id, path='.', chroot=None, force=False):
+    """Sign packages that are not already signed by key_id.
+
+    With force set every package is re-signed. Returns SigningStats.
+    """
+    key = find_key(key_id)
+    if force:
+        unsigned, foreign, current = [], list(packages), []
+    else:
+        unsigned, foreign, current = inspect_packages(packages, key.key_id, path)
+    if unsigned:
+        _rpmsign(unsigned, key_id, path=path, chroot=chroot)
+    if foreign:
+        _rpmsign(foreign, key_id, path=path, chroot=chroot, resign=True)
+    return SigningStats(len(unsigned), len(foreign), len(current))
 
-def sign_packages(packages, key_id, path='.', chroot=None):
-    if key_id not in get_key_ids():
-        raise SigningError("key '{0}' not found".format(key_id))
-    if not packages:
-        return
 
+def sign_timeout(count, timeout=SIGN_TIMEOUT,
+                 package_timeout=SIGN_PACKAGE_TIMEOUT):
+    """Return the number of seconds allowed to sign count packages."""
+    return timeout + package_timeout * count
+
+
+def _rpmsign(packages, key_id, path='.', chroot=None, resign=False,
+             timeout=None, use_agent=False, passphrase=''):
+    import pexpect
+    mode = "--resign" if resign else "--addsign"
+    template = RPMSIGN_AGENT_CMD if use_agent else RPMSIGN_CMD
+    if timeout is None:
+        timeout = sign_timeout(len(packages))
     with CmdEnv(chroot=chroot, src=path, dst='/mnt') as env:
-        package_list = " ".join([os.path.join(env.dst, pkg) for pkg in packages])
-        proc = env.call_with_expect(RPMSIGN_CMD % (key_id, package_list))
-        proc.expect('Enter pass phrase: ')
-        proc.send('\n')
-        proc.expect(pexpect.EOF)
-        proc.close()
+        package_list = " ".join([pipes.quote(os.path.join(env.dst, pkg))
+                                 for pkg in packages])
+        with command("rpmsign"):
+            proc = env.call_with_expect(template % (key_id, mode, package_list),
+                                        timeout=timeout)
+            try:
+                # rpmsign from rpm 4.13 on leaves the passphrase to gpg-agent
+                # and does not ask for it
+                if proc.expect(['Enter pass phrase: ', pexpect.EOF]) == 0:
+                    proc.send(passphrase + '\n')
+                    proc.expect(pexpect.EOF)
+            except pexpect.TIMEOUT:
+                raise SigningError("signing packages timed out after {0}s".format(timeout))
+            finally:
+                proc.close(force=True)
         if proc.exitstatus != 0:
-            raise SigningError("signing packages failed")
+            output = proc.before.strip().splitlines() if proc.before else []
+            raise SigningError("signing packages failed: {0}".format(
+                output[-1] if output else "exit status {0}".format(proc.exitstatus)))
+
+
+def make_batches(packages, size):
+    """Split a list of packages into lists of at most size packages."""
+    size = max(1, size)
+    return [packages[i:i + size] for i in range(0, len(packages), size)]
+
+
+def _preset_passphrase_cmd():
+    """Return the path of gpg-preset-passphrase, which is not on PATH."""
+    dirs = []
+    try:
+        output = subprocess.Popen(["gpgconf", "--list-dirs"], stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE).communicate()[0]
+        for line in output.splitlines():
+            if line.startswith("libexecdir:"):
+                dirs.append(line.split(":", 1)[1])
+    except OSError:
+        pass
+    dirs += ["/usr/libexec", "/usr/lib/gnupg2", "/usr/lib/gnupg"]
+    for d in dirs:
+        cmd = os.path.join(d, "gpg-preset-passphrase")
+        if os.access(cmd, os.X_OK):
+            return cmd
+    raise SigningError("gpg-preset-passphrase not found")
+
+
+class GpgAgent(object):
+    """A gpg-agent holding the passphrase of a signing key.
+
+    The agent is started once and the passphrase preset in it, so the
+    gpg run by rpmsign for each package signs without asking for it. An
+    agent already running for the keyring is reused for keys without a
+    passphrase and restarted otherwise.
+    """
+
+    def __init__(self, key, passphrase=''):
+        self.key = key
+        self.passphrase = passphrase
+        self.running = False
+        self.started = False
+
+    def _launch(self):
+        """Start gpg-agent, returning False if one is running already."""
+        try:
+            p = subprocess.Popen(["gpg-agent", "--daemon", "--sh",
+                                  "--allow-preset-passphrase"],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as err:
+            raise SigningError("unable to start gpg-agent: {0}".format(err))
+        output = p.communicate()[0]
+        # GnuPG 2.0 agents are found through GPG_AGENT_INFO
+        match = re.search(r"GPG_AGENT_INFO=([^;\s]+)", output)
+        if match:
+            os.environ["GPG_AGENT_INFO"] = match.group(1)
+        return p.returncode == 0
+
+    def start(self):
+        self.started = self._launch()
+        if self.passphrase and not self.started:
+            # gpg starts an agent of its own when listing keys, which
+            # does not take preset passphrases; replace it with ours
+            with open(os.devnull, "w") as devnull:
+                subprocess.call(["gpgconf", "--kill", "gpg-agent"],
+                                stdout=devnull, stderr=devnull)
+            for attempt in range(AGENT_START_ATTEMPTS):
+                self.started = self._launch()
+                if self.started:
+                    break
+                time.sleep(0.2)
+        self.running = True
+        if self.passphrase:
+            for keygrip in self._keygrips():
+                self._preset(["--preset", keygrip], self.passphrase)
+
+    def _keygrips(self):
+        p = subprocess.Popen(["gpg", "-K", "--with-colons", "--with-keygrip",
+                              self.key.key_id],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = p.communicate()[0]
+        keygrips = [line.split(":")[9] for line in output.splitlines()
+                    if line.startswith("grp:") and len(line.split(":")) > 9]
+        if not keygrips:
+            raise SigningError("no keygrip found for key '{0}'".format(self.key.key_id))
+        return keygrips
+
+    def _preset(self, args, data=None):
+        p = subprocess.Popen([_preset_passphrase_cmd()] + args,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        output = p.communicate(data)[1]
+        if p.returncode != 0:
+            raise SigningError("gpg-preset-passphrase failed: {0}".format(
+                output.strip() or "exit status {0}".format(p.returncode)))
+
+    def close(self):
+        # Stopping the agent drops the passphrase; an agent that was
+        # running already never had it preset
+        if self.started:
+            with open(os.devnull, "w") as devnull:
+                subprocess.call(["gpgconf", "--kill", "gpg-agent"],
+                                stdout=devnull, stderr=devnull)
+        self.running = self.started = False
+
+
+class SigningPool(object):
+    """Signs batches of packages with up to workers concurrent rpmsign runs.
+
+    A single GpgAgent holds the key's passphrase from the first batch
+    until close(), so a pool can be shared by every directory of a
+    promotion without a passphrase exchange per batch.
+    """
+
+    def __init__(self, key_id, workers=1, passphrase='', timeout=SIGN_TIMEOUT,
+                 package_timeout=SIGN_PACKAGE_TIMEOUT):
+        self.key = find_key(key_id)
+        self.key_id = key_id
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.package_timeout = package_timeout
+        self.agent = GpgAgent(self.key, passphrase)
+        self.lock = threading.Lock()
+        # Concurrent calls to sign() share the rpmsign slots
+        self.slots = threading.Semaphore(self.workers)
+
+    def _sign_batch(self, path, packages, resign):
+        timeout = sign_timeout(len(packages), self.timeout, self.package_timeout)
+        with self.slots:
+            _rpmsign(packages, self.key_id, path=path, resign=resign,
+                     timeout=timeout, use_agent=True,
+                     passphrase=self.agent.passphrase)
+
+    def sign(self, batches):
+        """Sign a list of (path, packages, resign) batches.
+
+        Every failed batch is reported and a SigningError is raised once
+        all batches have run.
+        """
+        batches = [batch for batch in batches if batch[1]]
+        if not batches:
+            return
+        with self.lock:
+            if not self.agent.running:
+                self.agent.start()
+        queue = Queue.Queue()
+        for batch in batches:
+            queue.put(batch)
+        failures = []
+        spans = current_spans()
+
+        def _worker():
+            with within(spans):
+                while True:
+                    try:
+                        path, packages, resign = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        self._sign_batch(path, packages, resign)
+                    except Exception as err:
+                        failures.append((path, packages, err))
+
+        threads = [threading.Thread(target=_worker)
+                   for i in range(min(self.workers, len(batches)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for path, packages, err in failures:
+            print("Error: failed to sign {0} package(s) in '{1}': {2}".format(
+                len(packages), path, err))
+            for pkg in packages:
+                print("Error:   {0}".format(pkg))
+        if failures:
+            raise SigningError("{0} of {1} signing batches failed".format(
+                len(failures), len(batches)))
+
+    def close(self):
+        with self.lock:
+            self.agent.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type=None, value=None, traceback=None):
+        self.close()
 
 
 def set_gpghome(gpghome):
@@ -75,6 +381,7 @@ def set_gpghome(gpghome):
     os.environ['GNUPGHOME'] = expanded_gpghome
     # Fix perms so we don't get warnings
     os.chmod(expanded_gpghome, stat.S_IRWXU)
+    invalidate_keyring()
 
 
 def export_public_key(keyname):
@@ -88,16 +395,128 @@ def export_public_key_file(keyname, filename):
         fp.write(export_public_key(keyname))
 
 
-def get_key_ids():
-    p = subprocess.Popen(["gpg", "-K"], stdout=subprocess.PIPE,
-                         stderr=subprocess.PIPE)
-    output, _ = p.communicate()
-    keys = []
-    for line in output.split("\n"):
-        if line.startswith("sec"):
+class Key(object):
+    """A secret key from the keyring."""
+
+    def __init__(self, key_id, fingerprint=None, uids=None):
+        self.key_id = key_id.upper()
+        self.fingerprint = fingerprint.upper() if fingerprint else None
+        self.uids = uids or []
+
+    @property
+    def short_id(self):
+        return self.key_id[-8:]
+
+    def matches(self, key_id):
+        """Check key_id against the short ID, long ID and fingerprint."""
+        key_id = key_id.upper().replace(" ", "")
+        if key_id.startswith("0X"):
+            key_id = key_id[2:]
+        return key_id in (self.short_id, self.key_id, self.fingerprint)
+
+    def __repr__(self):
+        return '<key: {0}>'.format(self.key_id)
+
+
+class Keyring(object):
+    """Secret keys listed by a single run of gpg.
+
+    The listing is tied to the GNUPGHOME it was read from and the
+    modification times of the keyring files, see is_current().
+    """
+
+    def __init__(self, keys, stamp=None):
+        self.keys = keys
+        self.stamp = stamp
+
+    @staticmethod
+    def gpghome():
+        return os.environ.get('GNUPGHOME', os.path.expanduser('~/.gnupg'))
+
+    @staticmethod
+    def make_stamp():
+        gpghome = Keyring.gpghome()
+        mtimes = []
+        for name in KEYRING_FILES:
             try:
-                key = re.search(r'/([\w]+)', line).groups()[0]
-                keys.append(key)
-            except Exception:
+                mtimes.append((name, os.stat(os.path.join(gpghome, name)).st_mtime))
+            except OSError:
                 pass
-    return keys
+        return (gpghome, tuple(mtimes))
+
+    @classmethod
+    def load(cls):
+        stamp = cls.make_stamp()
+        p = subprocess.Popen(["gpg", "-K", "--with-colons", "--fixed-list-mode",
+                              "--with-fingerprint"],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, _ = p.communicate()
+        return cls(cls.parse(output), stamp)
+
+    @staticmethod
+    def parse(output):
+        """Parse gpg --with-colons output into a list of Keys."""
+        keys = []
+        last = None
+        for line in output.split("\n"):
+            fields = line.split(":")
+            if fields[0] == "sec" and len(fields) > 4:
+                keys.append(Key(fields[4]))
+                last = fields[0]
+            elif fields[0] in ("ssb", "sub"):
+                last = fields[0]
+            elif fields[0] == "fpr" and last == "sec" and len(fields) > 9:
+                if keys[-1].fingerprint is None:
+                    keys[-1].fingerprint = fields[9].upper()
+            elif fields[0] == "uid" and keys and len(fields) > 9:
+                keys[-1].uids.append(fields[9])
+        return keys
+
+    def is_current(self):
+        return self.stamp == Keyring.make_stamp()
+
+    def find(self, key_id):
+        for key in self.keys:
+            if key.matches(key_id):
+                return key
+        return None
+
+    def __contains__(self, key_id):
+        return self.find(key_id) is not None
+
+    @property
+    def key_ids(self):
+        return [key.short_id for key in self.keys]
+
+
+_keyring = None
+_keyring_lock = threading.Lock()
+
+
+def get_keyring():
+    """Return the cached Keyring, reloading it if gpg's files changed."""
+    global _keyring
+    with _keyring_lock:
+        if _keyring is None or not _keyring.is_current():
+            _keyring = Keyring.load()
+        return _keyring
+
+
+def invalidate_keyring():
+    global _keyring
+    with _keyring_lock:
+        _keyring = None
+
+
+def find_key(key_id):
+    """Return the Key for key_id or raise SigningError."""
+    if not key_id:
+        raise SigningError("no signing key given")
+    key = get_keyring().find(key_id)
+    if key is None:
+        raise SigningError("key '{0}' not found".format(key_id))
+    return key
+
+
+def get_key_ids():
+    return get_keyring().key_ids
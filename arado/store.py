@@ -0,0 +1,86 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+import os
+
+from .config import get_config
+from .utils import link_or_copy, makedirs
+
+
+class ArtifactStore(object):
+    """Signed packages addressed by their unsigned content and signing key.
+
+    A package is stored under the sha256 digest of the file before it was
+    signed and the long ID of the key that signed it, so the same build
+    promoted into several repositories is copied and signed only once.
+    Files are shared with the repositories through hardlinks where the
+    filesystem allows it.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, digest, key_id):
+        return os.path.join(self.root, key_id.upper(), digest[:2],
+                            digest + ".rpm")
+
+    def lookup(self, digest, key_id):
+        """Return the path of the stored package or None."""
+        path = self.path(digest, key_id)
+        if os.path.isfile(path):
+            return path
+        return None
+
+    def add(self, filename, digest, key_id):
+        """Store filename, a package signed with key_id."""
+        path = self.path(digest, key_id)
+        if os.path.exists(path):
+            return path
+        makedirs(os.path.dirname(path))
+        link_or_copy(filename, path)
+        return path
+
+    def link(self, digest, key_id, dest):
+        """Place the stored package at dest; returns False if not stored."""
+        path = self.lookup(digest, key_id)
+        if path is None:
+            return False
+        link_or_copy(path, dest)
+        return True
+
+
+def get_store():
+    """Return the ArtifactStore configured in [paths], or None."""
+    root = get_config().paths().getpath('signed-store')
+    if not root:
+        return None
+    return ArtifactStore(root)
@@ -30,15 +30,351 @@
 #
 # Author: Matt Spaulding mspaulding@eucalyptus.com
 
+import errno
+import fnmatch
 import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+from HTMLParser import HTMLParser
 from subprocess import check_call, CalledProcessError
 
-from BeautifulSoup import BeautifulSoup
-import pexpect
+from .metrics import command
+
+
+class LinkParser(HTMLParser):
+    """Collects the href and text of every <a> element fed to it."""
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = []
+        self._href = None
+        self._text = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            self._href = dict(attrs).get("href") or ""
+            self._text = []
+
+    def handle_data(self, data):
+        if self._href is not None:
+            self._text.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == "a" and self._href is not None:
+            self.links.append((self._href, "".join(self._text).strip()))
+            self._href = None
+
+    def pop_links(self):
+        links, self.links = self.links, []
+        return links
+
+
+def iter_links(chunks):
+    """Yield (href, text) for each link in HTML arriving in chunks."""
+    parser = LinkParser()
+    for chunk in chunks:
+        parser.feed(chunk)
+        for link in parser.pop_links():
+            yield link
+    parser.close()
+    for link in parser.pop_links():
+        yield link
+
+
+def iter_package_links(chunks, pattern="*.rpm"):
+    """Yield the names of the files matching pattern in a directory index.
+
+    Links with a path, such as the parent directory, are skipped.
+    """
+    for href, text in iter_links(chunks):
+        name = urllib.unquote(href.split("?")[0].split("#")[0])
+        if name and "/" not in name and fnmatch.fnmatch(name, pattern):
+            yield name
 
 
 def links_from_html(html):
-    return [link.string.strip() for link in BeautifulSoup(html).findAll('a')]
+    return [text for href, text in iter_links([html])]
+
+
+def walkerror(error):
+    pass
+
+
+def makedirs(path):
+    """Create path and its parents, if it does not exist already."""
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+
+def parallel_map(func, items, workers=1):
+    """Map func over items using up to workers threads."""
+    items = list(items)
+    workers = max(1, min(workers, len(items)))
+    if workers == 1:
+        return [func(item) for item in items]
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Largest request passed to the kernel copy calls at once
+KERNEL_COPY_CHUNK = 1 << 30
+# Errors meaning the kernel cannot copy between these files
+KERNEL_COPY_FALLBACK = (errno.ENOSYS, errno.EXDEV, errno.EINVAL,
+                        errno.EOPNOTSUPP, errno.EBADF)
+
+_kernel_copy_calls = None
+
+
+def _get_kernel_copy_calls():
+    """Return wrappers for copy_file_range(2) and sendfile(2) from libc."""
+    global _kernel_copy_calls
+    if _kernel_copy_calls is not None:
+        return _kernel_copy_calls
+    import ctypes
+    import ctypes.util
+    _kernel_copy_calls = []
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        return _kernel_copy_calls
+    if hasattr(libc, "copy_file_range"):
+        copy_file_range = libc.copy_file_range
+        copy_file_range.restype = ctypes.c_ssize_t
+        copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                                    ctypes.c_void_p, ctypes.c_size_t,
+                                    ctypes.c_uint]
+        _kernel_copy_calls.append(
+            lambda infd, outfd, count: copy_file_range(infd, None, outfd, None,
+                                                       count, 0))
+    if hasattr(libc, "sendfile"):
+        sendfile = libc.sendfile
+        sendfile.restype = ctypes.c_ssize_t
+        sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                             ctypes.c_size_t]
+        _kernel_copy_calls.append(
+            lambda infd, outfd, count: sendfile(outfd, infd, None, count))
+    return _kernel_copy_calls
+
+
+def _get_errno():
+    import ctypes
+    return ctypes.get_errno()
+
+
+def _kernel_copy(infd, outfd, size):
+    """Copy size bytes between file descriptors without leaving the kernel.
+
+    Returns False if neither copy_file_range nor sendfile can be used.
+    """
+    for call in _get_kernel_copy_calls():
+        copied = 0
+        while copied < size:
+            count = call(infd, outfd, min(size - copied, KERNEL_COPY_CHUNK))
+            if count > 0:
+                copied += count
+            elif count == 0:
+                return True
+            else:
+                err = _get_errno()
+                if copied or err not in KERNEL_COPY_FALLBACK:
+                    raise OSError(err, os.strerror(err))
+                break
+        else:
+            return True
+    return False
+
+
+# renameat2(2) flag swapping the two paths, and its system call numbers
+# for C libraries without a wrapper
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+RENAMEAT2_SYSCALLS = {"x86_64": 316, "aarch64": 276, "ppc64le": 357}
+
+_renameat2 = None
+
+
+def _get_renameat2():
+    """Return a wrapper for renameat2(2), or None if it is unavailable."""
+    global _renameat2
+    if _renameat2 is not None:
+        return _renameat2 or None
+    import ctypes
+    import ctypes.util
+    import platform
+    _renameat2 = False
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        return None
+    if hasattr(libc, "renameat2"):
+        call = libc.renameat2
+        call.restype = ctypes.c_int
+        call.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int,
+                         ctypes.c_char_p, ctypes.c_uint]
+        _renameat2 = call
+    elif platform.machine() in RENAMEAT2_SYSCALLS:
+        number = RENAMEAT2_SYSCALLS[platform.machine()]
+        syscall = libc.syscall
+        syscall.restype = ctypes.c_long
+        _renameat2 = lambda olddirfd, old, newdirfd, new, flags: syscall(
+            number, olddirfd, ctypes.c_char_p(old), newdirfd,
+            ctypes.c_char_p(new), ctypes.c_uint(flags))
+    return _renameat2 or None
+
+
+def exchange_paths(path1, path2):
+    """Atomically swap two paths, such as a directory and a symlink.
+
+    Returns False if the kernel or the filesystem cannot exchange them.
+    """
+    call = _get_renameat2()
+    if call is None:
+        return False
+    if call(AT_FDCWD, path1, AT_FDCWD, path2, RENAME_EXCHANGE) == 0:
+        return True
+    err = _get_errno()
+    if err in (errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+        return False
+    raise OSError(err, os.strerror(err))
+
+
+def copy_file(src, dst):
+    """Copy src to dst with its metadata, like shutil.copy2.
+
+    The data is copied by the kernel where possible and written under a
+    temporary name, so an existing dst (which may be a hardlink into a
+    published repository) is replaced rather than overwritten. Returns
+    the number of bytes copied.
+    """
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(dst),
+                                   prefix="." + os.path.basename(dst))
+    try:
+        with os.fdopen(fd, "wb") as fdst:
+            with open(src, "rb") as fsrc:
+                size = os.fstat(fsrc.fileno()).st_size
+                if not _kernel_copy(fsrc.fileno(), fdst.fileno(), size):
+                    shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+        shutil.copystat(src, tmpfile)
+        os.rename(tmpfile, dst)
+    except:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        raise
+    return size
+
+
+def link_or_copy(src, dst):
+    """Replace dst with a hardlink to src, or a copy where links fail.
+
+    The link is made under a temporary name, so dst never appears half
+    written. Only a filesystem that cannot link src to dst falls back to
+    a copy; other errors are raised.
+    """
+    fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(dst),
+                                   prefix="." + os.path.basename(dst))
+    os.close(fd)
+    os.unlink(tmpfile)
+    try:
+        os.link(src, tmpfile)
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+            raise
+        copy_file(src, dst)
+        return
+    try:
+        os.rename(tmpfile, dst)
+    except:
+        os.unlink(tmpfile)
+        raise
+
+
+class TransferStats(object):
+    """Counts of files and bytes moved and the time taken."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.started = time.time()
+        self.finished = None
+
+    def add(self, size):
+        self.files += 1
+        self.bytes += size
+
+    def stop(self):
+        self.finished = time.time()
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def __str__(self):
+        megabytes = self.bytes / (1024.0 * 1024.0)
+        return "{0} files, {1:.1f} MB in {2:.1f}s ({3:.1f} MB/s)".format(
+            self.files, megabytes, self.elapsed,
+            megabytes / self.elapsed if self.elapsed else 0.0)
+
+
+class PrefixedOutput(object):
+    """A replacement for sys.stdout that labels lines by thread.
+
+    Lines written by a thread that has set a prefix are written whole,
+    with the prefix, so the output of concurrent jobs can be told apart.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def set_prefix(self, prefix):
+        self.flush()
+        self.local.prefix = prefix
+        self.local.buffer = ""
+
+    def write(self, data):
+        prefix = getattr(self.local, "prefix", None)
+        if prefix is None:
+            with self.lock:
+                self.stream.write(data)
+            return
+        lines = (self.local.buffer + data).split("\n")
+        self.local.buffer = lines.pop()
+        with self.lock:
+            for line in lines:
+                self.stream.write("[{0}] {1}\n".format(prefix, line))
+            self.stream.flush()
+
+    def flush(self):
+        if getattr(self.local, "buffer", ""):
+            self.write("\n")
+        with self.lock:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def output_prefix(prefix):
+    """Prefix the lines this thread prints, if output is being prefixed."""
+    if isinstance(sys.stdout, PrefixedOutput):
+        sys.stdout.set_prefix(prefix)
 
 
 class CommandEnvironment(object):
@@ -70,6 +406,7 @@ class CommandEnvironment(object):
         return self.chroot_prefix + cmd
 
     def call_with_expect(self, cmd, timeout=120):
+        import pexpect
         if isinstance(cmd, list):
             cmd = " ".join(cmd)
         expect = pexpect.spawn(self._get_cmd(cmd), timeout=timeout)
@@ -81,6 +418,19 @@ class CommandEnvironment(object):
             cmd = cmd.split(" ")
         if self.chroot_prefix:
             cmd = cmd.insert(0, self.chroot_prefix)
+        with command(cmd):
+            self._call(cmd, cwd)
+
+    def _call(self, cmd, cwd=None):
+        if isinstance(sys.stdout, PrefixedOutput):
+            # Pass the output through so it gets this thread's prefix
+            proc = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            for line in iter(proc.stdout.readline, ""):
+                sys.stdout.write(line)
+            if proc.wait() != 0:
+                raise Exception("Command {0} failed with status {1}".format(cmd, proc.returncode))
+            return
         try:
             if cwd:
                 check_call(cmd, cwd=cwd)
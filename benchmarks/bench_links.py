@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+"""Compare the directory index link parsers.
+
+Times arado.utils.links_from_html and the streaming iter_package_links
+on a generated Apache index, against the BeautifulSoup 3 parser they
+replaced when it is installed.
+"""
+
+import os
+import sys
+import timeit
+
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from arado.utils import iter_package_links, links_from_html
+
+
+def make_index(count):
+    rows = ['<li><a href="/repository/">Parent Directory</a></li>']
+    for i in range(count):
+        name = "eucalyptus-{0}-0.{0}.el6.x86_64.rpm".format(i)
+        rows.append('<li><a href="{0}">{0}</a></li>'.format(name))
+    return ("<html><head><title>Index</title></head><body><ul>\n" +
+            "\n".join(rows) + "\n</ul></body></html>\n")
+
+
+def chunked(data, size=64 * 1024):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def soup_links(html):
+    from BeautifulSoup import BeautifulSoup
+    return [link.string.strip() for link in BeautifulSoup(html).findAll('a')]
+
+
+def run(count, repeat):
+    html = make_index(count)
+    chunks = chunked(html)
+    cases = [
+        ("links_from_html", lambda: links_from_html(html)),
+        ("iter_package_links", lambda: list(iter_package_links(chunks))),
+    ]
+    try:
+        import BeautifulSoup
+        cases.insert(0, ("beautifulsoup3", lambda: soup_links(html)))
+    except ImportError:
+        print("beautifulsoup3: not installed")
+    results = {}
+    for name, func in cases:
+        results[name] = min(timeit.repeat(func, number=1, repeat=repeat))
+        print("{0}: {1:.4f}s for {2} links".format(name, results[name], count))
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark directory index parsing")
+    parser.add_argument("--count", dest="count", type=int, default=20000,
+        help="number of packages in the index (default: 20000)")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=3,
+        help="number of timed runs; the best is reported (default: 3)")
+    args = parser.parse_args()
+    run(args.count, args.repeat)
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+"""Benchmark the repository operations on synthetic repositories.
+
+A published repository and a newer build are generated with
+synthetic.py in a scratch directory, and arado is pointed at them
+through ARADO_CONFIG. Unless --real-createrepo is given, rebuilds use a
+stub createrepo that only writes repomd.xml, so they measure arado's
+own overhead.
+
+Results are compared with a JSON baseline and any case slower than
+the baseline by more than the tolerance is reported as a regression,
+with exit status 1. --save records the results as the new baseline.
+"""
+
+import fnmatch
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+from bench_links import make_index
+from synthetic import make_repo
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+
+# Differences smaller than this are noise, whatever the ratio
+NOISE_FLOOR = 0.005
+
+STUB_CREATEREPO = """#!/bin/sh
+# Stand-in for createrepo: the last argument is the repository
+for dir; do :; done
+mkdir -p "$dir/repodata" && echo '<repomd/>' > "$dir/repodata/repomd.xml"
+"""
+
+CONFIG = """[general]
+staging = snapshot
+publish = move
+publish-keep = 1
+copy-workers = {workers}
+rebuild-workers = {workers}
+createrepo = {createrepo}
+
+[paths]
+source = {work}/source
+destination = {work}/dest
+repotemp = {work}/tmp
+
+[projects]
+
+[mappings]
+"""
+
+
+class Workspace(object):
+    """Scratch repositories and config for the benchmarks."""
+
+    def __init__(self, count, size, workers, real_createrepo=False):
+        self.work = tempfile.mkdtemp(prefix="arado-bench-")
+        self.published = os.path.join(self.work, "dest", "published")
+        self.build = os.path.join(self.work, "source", "build")
+        os.makedirs(os.path.join(self.work, "tmp"))
+        make_repo(self.published, count, size, release="1")
+        make_repo(self.build, count, size, release="2")
+        if real_createrepo:
+            createrepo = "/usr/bin/createrepo"
+        else:
+            createrepo = os.path.join(self.work, "createrepo")
+            with open(createrepo, "w") as fp:
+                fp.write(STUB_CREATEREPO)
+            os.chmod(createrepo, 0755)
+        config = os.path.join(self.work, "arado.conf")
+        with open(config, "w") as fp:
+            fp.write(CONFIG.format(work=self.work, workers=workers,
+                                   createrepo=createrepo))
+        os.environ["ARADO_CONFIG"] = config
+
+    def scratch(self, name):
+        return os.path.join(self.work, "tmp", name)
+
+    def copy(self, path, name):
+        dest = self.scratch(name)
+        shutil.copytree(path, dest, symlinks=True)
+        return dest
+
+    def remove(self, *paths):
+        for path in paths:
+            if os.path.islink(path):
+                os.unlink(path)
+            elif os.path.exists(path):
+                shutil.rmtree(path)
+
+    def cleanup(self):
+        shutil.rmtree(self.work, ignore_errors=True)
+
+
+def timed(func, *args, **kwargs):
+    started = time.time()
+    func(*args, **kwargs)
+    return time.time() - started
+
+
+def bench_stage_copy(ws):
+    from arado import repo
+    result = []
+    elapsed = timed(lambda: result.append(repo.stage(ws.published, True, "copy")))
+    ws.remove(*result)
+    return elapsed
+
+
+def bench_stage_snapshot(ws):
+    from arado import repo
+    result = []
+    elapsed = timed(lambda: result.append(repo.stage(ws.published, True, "snapshot")))
+    ws.remove(*result)
+    return elapsed
+
+
+def bench_merge(ws):
+    from arado import repo
+    staged = repo.stage(ws.published, True, "snapshot")
+    elapsed = timed(repo.merge, ws.build, staged, origin=ws.published)
+    ws.remove(staged)
+    return elapsed
+
+
+def bench_replace_move(ws):
+    from arado import repo
+    target = ws.copy(ws.published, "replace-target")
+    staged = repo.stage(ws.published, True, "snapshot")
+    elapsed = timed(repo.replace, staged, target, "move")
+    ws.remove(target, staged)
+    return elapsed
+
+
+def bench_replace_symlink(ws):
+    from arado import repo
+    target = ws.scratch("publish-target")
+    staged = repo.stage(ws.published, True, "snapshot")
+    elapsed = timed(repo.replace, staged, target, "symlink")
+    ws.remove(target, repo.generations_dir(target))
+    return elapsed
+
+
+def bench_rebuild(ws):
+    from arado import repo
+    tree = ws.copy(ws.published, "rebuild")
+    elapsed = sum(timed(repo.rebuild, os.path.join(tree, "rhel", "6", arch))
+                  for arch in ("i386", "x86_64"))
+    ws.remove(tree)
+    return elapsed
+
+
+def bench_rebuild_unchanged(ws):
+    from arado import repo
+    tree = ws.copy(ws.published, "rebuild")
+    repo_dirs = [os.path.join(tree, "rhel", "6", arch) for arch in ("i386", "x86_64")]
+    for repo_dir in repo_dirs:
+        repo.rebuild(repo_dir, incremental=True)
+    # The second rebuild finds nothing changed
+    elapsed = sum(timed(repo.rebuild, repo_dir, incremental=True)
+                  for repo_dir in repo_dirs)
+    ws.remove(tree)
+    for repo_dir in repo_dirs:
+        ws.remove(repo.metadata_cachedir(repo_dir))
+    return elapsed
+
+
+def bench_links_from_html(ws):
+    from arado.utils import links_from_html
+    html = make_index(20000)
+    return timed(links_from_html, html)
+
+
+def bench_get_config(ws):
+    from arado.config import get_config
+
+    def _lookups():
+        for i in range(10000):
+            get_config().general().getint('copy-workers', 1)
+    return timed(_lookups)
+
+
+CASES = [
+    ("stage-copy", bench_stage_copy),
+    ("stage-snapshot", bench_stage_snapshot),
+    ("merge", bench_merge),
+    ("replace-move", bench_replace_move),
+    ("replace-symlink", bench_replace_symlink),
+    ("rebuild", bench_rebuild),
+    ("rebuild-unchanged", bench_rebuild_unchanged),
+    ("links_from_html", bench_links_from_html),
+    ("get_config", bench_get_config),
+]
+
+
+def run(ws, cases, repeat):
+    results = {}
+    stdout = sys.stdout
+    for name, func in cases:
+        runs = []
+        for i in range(repeat):
+            # arado reports its progress on stdout
+            sys.stdout = open(os.devnull, "w")
+            try:
+                runs.append(func(ws))
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+        results[name] = min(runs)
+        print("{0}: {1:.4f}s".format(name, results[name]))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print how results compare with baseline; return the regressions."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before, after = baseline[name], results[name]
+        change = (after - before) / before if before else 0.0
+        regressed = change > tolerance and after - before > NOISE_FLOOR
+        print("{0}: {1:.4f}s -> {2:.4f}s ({3:+.0%}){4}".format(
+            name, before, after, change, "  REGRESSION" if regressed else ""))
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark arado repository operations")
+    parser.add_argument("--count", dest="count", type=int, default=200,
+        help="number of packages per architecture (default: 200)")
+    parser.add_argument("--size", dest="size", type=int, default=64 * 1024,
+        help="payload size of each package in bytes (default: 65536)")
+    parser.add_argument("--workers", dest="workers", type=int, default=4,
+        help="copy-workers and rebuild-workers to configure (default: 4)")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=3,
+        help="number of timed runs; the best is reported (default: 3)")
+    parser.add_argument("--only", dest="only", metavar="PATTERN",
+        help="run only the cases matching PATTERN (e.g. 'stage-*')")
+    parser.add_argument("--real-createrepo", action="store_true", default=False,
+        dest="real_createrepo", help="run /usr/bin/createrepo instead of a stub")
+    parser.add_argument("--baseline", dest="baseline", default=DEFAULT_BASELINE,
+        help="baseline results file (default: benchmarks/baseline.json)")
+    parser.add_argument("--save", action="store_true", dest="save", default=False,
+        help="record the results as the new baseline")
+    parser.add_argument("--tolerance", dest="tolerance", type=float, default=0.25,
+        help="slowdown allowed before a case is flagged (default: 0.25)")
+    args = parser.parse_args()
+
+    cases = [(name, func) for name, func in CASES
+             if not args.only or fnmatch.fnmatch(name, args.only)]
+    params = {"count": args.count, "size": args.size, "workers": args.workers,
+              "real_createrepo": args.real_createrepo,
+              "python": platform.python_version()}
+
+    ws = Workspace(args.count, args.size, args.workers, args.real_createrepo)
+    try:
+        results = run(ws, cases, args.repeat)
+    finally:
+        ws.cleanup()
+
+    if args.save:
+        with open(args.baseline, "w") as fp:
+            json.dump({"params": params, "results": results}, fp,
+                      indent=2, sort_keys=True)
+            fp.write("\n")
+        print("Info: saved baseline to {0}".format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        if baseline.get("params") != params:
+            print("Warning: baseline was recorded with {0}".format(baseline.get("params")))
+        print("Comparison with {0}:".format(args.baseline))
+        if compare(results, baseline["results"], args.tolerance):
+            sys.exit(1)
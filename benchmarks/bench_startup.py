@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+"""Measure the startup cost of the arado command line.
+
+Each case runs in a fresh interpreter, which reports how long its
+imports took and which of the heavy optional modules they loaded.
+Those modules should only appear for the commands that use them.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+from argparse import ArgumentParser
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+HEAVY_MODULES = ("pexpect", "requests", "jinja2", "sqlite3", "ctypes",
+                 "multiprocessing", "arado.repo", "arado.signing")
+
+CASES = [
+    ("arado", "import arado"),
+    ("arado.cli", "import arado.cli; arado.cli.build_parser()"),
+    ("arado.api", "import arado.api"),
+    ("arado.repo", "import arado.repo"),
+]
+
+PROBE = """
+import sys, time, json
+started = time.time()
+{0}
+elapsed = time.time() - started
+print(json.dumps({{"elapsed": elapsed,
+                   "modules": len(sys.modules),
+                   "heavy": [m for m in {1!r} if m in sys.modules]}}))
+"""
+
+
+def probe(statement):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [ROOT] + [p for p in [env.get("PYTHONPATH")] if p])
+    output = subprocess.Popen(
+        [sys.executable, "-c", PROBE.format(statement, HEAVY_MODULES)],
+        stdout=subprocess.PIPE, env=env).communicate()[0]
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(repeat):
+    results = {}
+    for name, statement in CASES:
+        runs = [probe(statement) for i in range(repeat)]
+        best = min(runs, key=lambda r: r["elapsed"])
+        results[name] = best
+        print("{0}: {1:.1f}ms, {2} modules, heavy: {3}".format(
+            name, best["elapsed"] * 1000, best["modules"],
+            ", ".join(best["heavy"]) or "none"))
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark arado import and startup time")
+    parser.add_argument("--repeat", dest="repeat", type=int, default=5,
+        help="number of timed runs; the best is reported (default: 5)")
+    args = parser.parse_args()
+    run(args.repeat)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+"""Generate synthetic repositories for benchmarking.
+
+The packages are minimal RPM files: a lead, an unsigned signature
+header and a main header carrying the name, version, release and arch,
+followed by a payload of the requested size. arado.rpmfile reads them
+like real packages, but rpm itself will not install them.
+"""
+
+import hashlib
+import os
+import struct
+import sys
+
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from arado import rpmfile
+from arado.repo import NEW_REPO_TEMPL
+
+ARCHES = ("i386", "x86_64")
+
+RPMSIGTAG_SIZE = 1000
+
+COMPS = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE comps PUBLIC "-//Red Hat, Inc.//DTD Comps info//EN" "comps.dtd">
+<comps>
+</comps>
+"""
+
+
+def _header(entries):
+    index = []
+    store = ""
+    for tag, type_, data, count in entries:
+        index.append(struct.pack(">IIII", tag, type_, len(store), count))
+        store += data
+    return (rpmfile.HEADER_MAGIC + "\0" * 4 +
+            struct.pack(">II", len(entries), len(store)) + "".join(index) + store)
+
+
+def _payload(seed, size):
+    # Distinct for every package, but cheap to produce
+    block = hashlib.sha256(seed).digest() * 2048
+    return (block * (size // len(block) + 1))[:size]
+
+
+def make_rpm(filename, name, version, release, arch, size=4096):
+    """Write a minimal unsigned RPM file with a payload of size bytes."""
+    string = rpmfile.RPM_STRING_TYPE
+    header = _header([
+        (rpmfile.RPMTAG_NAME, string, name + "\0", 1),
+        (rpmfile.RPMTAG_VERSION, string, version + "\0", 1),
+        (rpmfile.RPMTAG_RELEASE, string, release + "\0", 1),
+        (rpmfile.RPMTAG_ARCH, string, arch + "\0", 1),
+        (rpmfile.RPMTAG_SOURCERPM, string,
+         "{0}-{1}-{2}.src.rpm\0".format(name, version, release), 1),
+    ])
+    payload = _payload(filename, size)
+    signature = _header([(RPMSIGTAG_SIZE, rpmfile.RPM_INT32_TYPE,
+                          struct.pack(">I", len(header) + len(payload)), 1)])
+    signature += "\0" * ((8 - len(signature) % 8) % 8)
+    lead = rpmfile.LEAD_MAGIC + "\0" * (rpmfile.LEAD_SIZE - len(rpmfile.LEAD_MAGIC))
+    with open(filename, "wb") as fp:
+        fp.write(lead + signature + header + payload)
+
+
+def make_repo(root, count=100, size=4096, release="1", arches=ARCHES):
+    """Create a repository tree under root with count packages per arch.
+
+    The tree follows NEW_REPO_TEMPL: each arch directory under rhel/6
+    holds the packages and a comps file, and the compatibility links
+    are created. Returns the list of repository directories.
+    """
+    for d in NEW_REPO_TEMPL["dirs"]:
+        if not os.path.isdir(os.path.join(root, d)):
+            os.makedirs(os.path.join(root, d))
+    for link in NEW_REPO_TEMPL["links"]:
+        if not os.path.lexists(os.path.join(root, link[1])):
+            os.symlink(link[0], os.path.join(root, link[1]))
+    repo_dirs = []
+    for d in NEW_REPO_TEMPL["dirs"]:
+        for arch in arches:
+            repo_dir = os.path.join(root, d, arch)
+            if not os.path.isdir(repo_dir):
+                os.makedirs(repo_dir)
+            with open(os.path.join(repo_dir, "comps.xml"), "w") as fp:
+                fp.write(COMPS)
+            for i in range(count):
+                name = "synthetic-{0}".format(i)
+                filename = "{0}-1.0-{1}.el6.{2}.rpm".format(name, release, arch)
+                make_rpm(os.path.join(repo_dir, filename), name, "1.0",
+                         "{0}.el6".format(release), arch, size)
+            repo_dirs.append(repo_dir)
+    return repo_dirs
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Generate a synthetic package repository")
+    parser.add_argument("root", help="directory to create the repository in")
+    parser.add_argument("--count", dest="count", type=int, default=100,
+        help="number of packages per architecture (default: 100)")
+    parser.add_argument("--size", dest="size", type=int, default=4096,
+        help="payload size of each package in bytes (default: 4096)")
+    parser.add_argument("--release", dest="release", default="1",
+        help="release of the generated packages (default: 1)")
+    args = parser.parse_args()
+    for repo_dir in make_repo(args.root, args.count, args.size, args.release):
+        print("Info: created {0}".format(repo_dir))
@@ -38,8 +38,9 @@ setup(name = "arado",
       long_description="Arado Package Repository Tools",
       author = "Matt Spaulding",
       author_email = "mspaulding@eucalyptus.com",
-      install_requires = ['argparse', 'requests', 'beautifulsoup', 'jinja2', 'pexpect'],
-      scripts = ["arado-describe-build",
+      install_requires = ['argparse', 'requests', 'jinja2', 'pexpect'],
+      scripts = ["bin/arado",
+                 "arado-describe-build",
                  "arado-promote-build",
                  "arado-describe-commit",
                  "arado-rebuild-repo"],
@@ -0,0 +1,196 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+"""Tests of promotion journals, their locks and cleanup.
+
+Run with: python -m unittest discover tests
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from arado.exception import PromotionError
+from arado.journal import STAGING_PREFIX, Journal, find_orphans, remove_journal
+
+IDENTITY = {"project": "eucalyptus", "commit": "abc", "dest": "/repo"}
+DAY = 24 * 3600
+
+# Holds the journal of IDENTITY until stdin is closed
+HOLDER = """
+import sys
+from arado.journal import Journal
+journal = Journal.open({0!r}, {1!r})
+sys.stdout.write("locked\\n")
+sys.stdout.flush()
+sys.stdin.read()
+"""
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.journals = os.path.join(self.tmpdir, "arado-journal")
+        self.origin = os.path.join(self.tmpdir, "origin")
+        os.mkdir(self.origin)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def staged(self, age=0):
+        path = tempfile.mkdtemp(dir=self.tmpdir, prefix=STAGING_PREFIX)
+        if age:
+            then = time.time() - age
+            os.utime(path, (then, then))
+        return path
+
+    def age(self, journal, age):
+        with open(journal.path) as fp:
+            data = json.load(fp)
+        data["created"] = time.time() - age
+        with open(journal.path, "w") as fp:
+            json.dump(data, fp)
+
+    def hold(self):
+        """Open the journal in another process, which holds it."""
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join(sys.path)
+        holder = subprocess.Popen(
+            [sys.executable, "-c", HOLDER.format(IDENTITY, self.journals)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+        self.assertEqual(holder.stdout.readline(), "locked\n")
+        self.addCleanup(holder.wait)
+        self.addCleanup(holder.stdin.close)
+        return holder
+
+    def test_resume(self):
+        staged = self.staged()
+        journal = Journal.open(IDENTITY, self.journals)
+        journal.start(staged, self.origin)
+        journal.record("copied", "build")
+        journal.close()
+        journal = Journal.open(IDENTITY, self.journals)
+        try:
+            self.assertTrue(journal.resumable(self.origin))
+            self.assertEqual(journal.staged, staged)
+            self.assertEqual(journal.steps, [("copied", "build")])
+            self.assertTrue(journal.done("copied", "build"))
+        finally:
+            journal.close()
+
+    def test_changed_origin_not_resumable(self):
+        journal = Journal.open(IDENTITY, self.journals)
+        journal.start(self.staged(), self.origin)
+        journal.close()
+        os.rmdir(self.origin)
+        os.mkdir(self.origin)
+        journal = Journal.open(IDENTITY, self.journals)
+        try:
+            self.assertFalse(journal.resumable(self.origin))
+        finally:
+            journal.close()
+
+    def test_locked_in_this_process(self):
+        journal = Journal.open(IDENTITY, self.journals)
+        try:
+            self.assertRaises(PromotionError, Journal.open, IDENTITY, self.journals)
+        finally:
+            journal.close()
+        Journal.open(IDENTITY, self.journals).close()
+
+    def test_locked_by_another_process(self):
+        holder = self.hold()
+        self.assertRaises(PromotionError, Journal.open, IDENTITY, self.journals)
+        holder.stdin.close()
+        holder.wait()
+        Journal.open(IDENTITY, self.journals).close()
+
+    def test_discard(self):
+        staged = self.staged()
+        journal = Journal.open(IDENTITY, self.journals)
+        journal.start(staged, self.origin)
+        journal.discard(remove_staged=True)
+        self.assertFalse(os.path.exists(staged))
+        self.assertEqual(os.listdir(self.journals), [])
+
+    def test_open_saves_new_owner(self):
+        journal = Journal.open(IDENTITY, self.journals)
+        journal.start(self.staged(), self.origin)
+        journal.close()
+        self.age(journal, DAY)
+        journal = Journal.open(IDENTITY, self.journals)
+        journal.close()
+        with open(journal.path) as fp:
+            data = json.load(fp)
+        self.assertEqual(data["pid"], os.getpid())
+        self.assertTrue(time.time() - data["created"] < DAY)
+
+    def test_orphans(self):
+        abandoned = self.staged(age=2 * DAY)
+        young = self.staged()
+        journal = Journal.open(IDENTITY, self.journals)
+        owned = self.staged(age=2 * DAY)
+        journal.start(owned, self.origin)
+        journal.close()
+        self.age(journal, 2 * DAY)
+        journals, dirs = find_orphans(DAY, self.journals, self.tmpdir)
+        self.assertEqual(journals, [journal.path])
+        # The staged tree of a journal only goes with the journal
+        self.assertEqual(dirs, [abandoned])
+        self.assertTrue(young not in dirs)
+
+        self.assertTrue(remove_journal(journal.path, remove_staged=True))
+        self.assertFalse(os.path.exists(owned))
+        self.assertEqual(os.listdir(self.journals), [])
+
+    def test_journal_in_use_is_not_orphaned(self):
+        journal = Journal.open(IDENTITY, self.journals)
+        owned = self.staged(age=2 * DAY)
+        journal.start(owned, self.origin)
+        journal.close()
+        self.hold()
+        # Aged after the holder opened it, like a resumed run
+        self.age(journal, 2 * DAY)
+        self.assertEqual(find_orphans(DAY, self.journals, self.tmpdir), ([], []))
+        self.assertFalse(remove_journal(journal.path, remove_staged=True))
+        self.assertTrue(os.path.isdir(owned))
+        self.assertTrue(os.path.exists(journal.path))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,133 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+"""Tests of merge planning from content manifests.
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from arado import rpmfile
+from arado.headercache import HeaderCache
+from arado.manifest import MergePlan
+
+from test_rpmfile import KEY_ID, _subpacket, make_rpm, v4_signature
+
+REPO_DIR = os.path.join("rhel", "6", "x86_64")
+
+
+class MergePlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source = os.path.join(self.tmpdir, "source")
+        self.dest = os.path.join(self.tmpdir, "dest")
+        for root in (self.source, self.dest):
+            os.makedirs(os.path.join(root, REPO_DIR, "repodata"))
+            self.write(root, "repodata/repomd.xml", root)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, root, name, data):
+        with open(os.path.join(root, REPO_DIR, name), "w") as fp:
+            fp.write(data)
+
+    def rpm(self, root, name, **kwargs):
+        make_rpm(os.path.join(root, REPO_DIR, name + "-1.0-1.el6.x86_64.rpm"),
+                 name, **kwargs)
+        return os.path.join(REPO_DIR, name + "-1.0-1.el6.x86_64.rpm")
+
+    def test_add_replace_skip(self):
+        added = self.rpm(self.source, "new")
+        unchanged = self.rpm(self.source, "same")
+        self.rpm(self.dest, "same")
+        self.write(self.source, "comps.xml", "new comps")
+        self.write(self.dest, "comps.xml", "old comps")
+        plan = MergePlan.build(self.source, self.dest)
+        self.assertEqual(plan.add, [added])
+        self.assertEqual(plan.replace, [os.path.join(REPO_DIR, "comps.xml")])
+        self.assertEqual(plan.skip, [unchanged])
+        self.assertEqual(plan.copies, plan.add + plan.replace)
+        self.assertEqual(plan.copy_bytes, sum(
+            os.path.getsize(os.path.join(self.source, name)) for name in plan.copies))
+
+    def test_signed_copy_is_unchanged(self):
+        name = self.rpm(self.source, "foo")
+        self.rpm(self.dest, "foo", signature=v4_signature(
+            unhashed=_subpacket(rpmfile.SUBPACKET_ISSUER, KEY_ID.decode("hex"))))
+        plan = MergePlan.build(self.source, self.dest)
+        self.assertEqual(plan.skip, [name])
+        self.assertEqual(plan.copies, [])
+
+    def test_metadata_left_out(self):
+        self.rpm(self.source, "foo")
+        plan = MergePlan.build(self.source, self.dest)
+        self.assertEqual(plan.source.repo_dirs, [REPO_DIR])
+        self.assertFalse([name for name in plan.source.entries if "repodata" in name])
+
+    def test_symlinks(self):
+        name = self.rpm(self.source, "foo")
+        os.symlink(os.path.join(self.tmpdir, "elsewhere.rpm"),
+                   os.path.join(self.dest, name))
+        os.symlink("rhel", os.path.join(self.source, "centos"))
+        plan = MergePlan.build(self.source, self.dest)
+        self.assertEqual(plan.links, [name])
+        self.assertEqual(plan.copies, [])
+        self.assertTrue("centos" in plan.source.links)
+        self.assertFalse([n for n in plan.source.entries if n.startswith("centos")])
+
+    def test_no_destination(self):
+        name = self.rpm(self.source, "foo")
+        plan = MergePlan.build(self.source, None)
+        self.assertEqual(plan.add, [name])
+
+    def test_header_cache(self):
+        self.rpm(self.source, "new")
+        self.rpm(self.source, "same")
+        self.rpm(self.dest, "same")
+        cache = HeaderCache(os.path.join(self.tmpdir, "headers.sqlite"))
+        try:
+            for i in range(2):
+                plan = MergePlan.build(self.source, self.dest, workers=2, cache=cache)
+                self.assertEqual(len(plan.add), 1)
+                self.assertEqual(len(plan.skip), 1)
+        finally:
+            cache.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
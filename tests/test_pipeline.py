@@ -0,0 +1,170 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+"""Tests of the copy -> sign -> index pipeline and its failure paths.
+
+Run with: python -m unittest discover tests
+"""
+
+import StringIO
+import os
+import sys
+import threading
+import unittest
+
+from arado.exception import PromotionError
+from arado.pipeline import Pipeline
+
+GROUPS = ["a", "b", "c"]
+NAMES = ["a/1.rpm", "a/2.rpm", "a/comps.xml", "b/1.rpm", "b/2.rpm", "top.txt"]
+
+
+class Recorder(object):
+    """Stage functions that record their calls and fail on request."""
+
+    def __init__(self, fail_copy=(), fail_sign=(), fail_index=()):
+        self.fail_copy = fail_copy
+        self.fail_sign = fail_sign
+        self.fail_index = fail_index
+        self.lock = threading.Lock()
+        self.copied = []
+        self.signed = []
+        self.batches = []
+        self.indexed = []
+
+    def copy(self, name):
+        if name in self.fail_copy:
+            raise IOError("no space left")
+        with self.lock:
+            self.copied.append(name)
+        return name if name.endswith(".rpm") else None
+
+    def sign(self, root, packages):
+        if root in self.fail_sign:
+            raise RuntimeError("rpmsign failed")
+        with self.lock:
+            self.batches.append(len(packages))
+            self.signed.extend(os.path.join(root, p) for p in packages)
+
+    def index(self, group):
+        if group in self.fail_index:
+            raise RuntimeError("createrepo failed")
+        with self.lock:
+            self.indexed.append(group)
+
+
+def group_of(name):
+    group = os.path.dirname(name)
+    return group if group in GROUPS else None
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def run_pipeline(self, stages, sign=True, **kwargs):
+        kwargs.setdefault("copy_workers", 3)
+        kwargs.setdefault("sign_workers", 2)
+        kwargs.setdefault("index_workers", 2)
+        pipeline = Pipeline(stages.copy, stages.index,
+                            stages.sign if sign else None, **kwargs)
+        pipeline.run(NAMES, GROUPS, group_of)
+
+    def test_success(self):
+        stages = Recorder()
+        self.run_pipeline(stages)
+        self.assertEqual(sorted(stages.copied), sorted(NAMES))
+        self.assertEqual(sorted(stages.signed),
+                         ["a/1.rpm", "a/2.rpm", "b/1.rpm", "b/2.rpm"])
+        # A group no file belongs to is indexed too
+        self.assertEqual(sorted(stages.indexed), GROUPS)
+
+    def test_without_signing(self):
+        stages = Recorder()
+        self.run_pipeline(stages, sign=False)
+        self.assertEqual(stages.signed, [])
+        self.assertEqual(sorted(stages.indexed), GROUPS)
+
+    def test_batch_size(self):
+        stages = Recorder()
+        self.run_pipeline(stages, batch_size=1)
+        self.assertEqual(stages.batches, [1] * 4)
+
+    def test_copy_failure(self):
+        stages = Recorder(fail_copy=["a/2.rpm"])
+        self.assertRaises(PromotionError, self.run_pipeline, stages)
+        # Everything else still runs, but the group is not indexed
+        self.assertEqual(len(stages.copied), len(NAMES) - 1)
+        self.assertEqual(sorted(stages.indexed), ["b", "c"])
+        self.assertTrue("copying a/2.rpm failed: no space left" in sys.stdout.getvalue())
+
+    def test_copy_failure_outside_groups(self):
+        stages = Recorder(fail_copy=["top.txt"])
+        self.assertRaises(PromotionError, self.run_pipeline, stages)
+        self.assertEqual(sorted(stages.indexed), GROUPS)
+
+    def test_sign_failure(self):
+        stages = Recorder(fail_sign=["b"])
+        self.assertRaises(PromotionError, self.run_pipeline, stages)
+        self.assertEqual(sorted(stages.indexed), ["a", "c"])
+        output = sys.stdout.getvalue()
+        self.assertTrue("signing in b failed: rpmsign failed" in output)
+        self.assertTrue("skipping b" in output)
+
+    def test_index_failure(self):
+        stages = Recorder(fail_index=["a"])
+        try:
+            self.run_pipeline(stages)
+        except PromotionError as err:
+            self.assertEqual(str(err), "1 step(s) of the promotion failed")
+        else:
+            self.fail("no PromotionError raised")
+        self.assertEqual(sorted(stages.indexed), ["b", "c"])
+
+    def test_every_failure_reported(self):
+        stages = Recorder(fail_copy=["a/1.rpm"], fail_sign=["b"], fail_index=["c"])
+        try:
+            self.run_pipeline(stages, batch_size=1)
+        except PromotionError as err:
+            self.assertEqual(str(err), "4 step(s) of the promotion failed")
+        else:
+            self.fail("no PromotionError raised")
+        self.assertEqual(stages.indexed, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,265 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2012-2013, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+# Author: Matt Spaulding mspaulding@eucalyptus.com
+
+"""Tests of RPM version comparison and signature header parsing.
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+
+from arado import rpmfile
+from arado.rpmfile import (RPMFileError, compare_evr, package_digests,
+                           pgp_signature_key_id, read_package, rpmvercmp,
+                           signature_key_id)
+
+KEY_ID = "2B916CEEDFC84359"
+RPMSIGTAG_SIZE = 1000
+
+
+def _header(entries):
+    index = []
+    store = ""
+    for tag, type_, data, count in entries:
+        index.append(struct.pack(">IIII", tag, type_, len(store), count))
+        store += data
+    return (rpmfile.HEADER_MAGIC + "\0" * 4 +
+            struct.pack(">II", len(entries), len(store)) + "".join(index) + store)
+
+
+def _subpacket(type_, body):
+    return chr(len(body) + 1) + chr(type_) + body
+
+
+def v4_signature(hashed="", unhashed=""):
+    """An OpenPGP v4 RSA signature packet in the new format."""
+    body = ("\x04\x00\x01\x08" + struct.pack(">H", len(hashed)) + hashed +
+            struct.pack(">H", len(unhashed)) + unhashed + "\xab\xcd" +
+            "\x00\x08\xff")
+    return "\xc2" + chr(len(body)) + body
+
+
+def v3_signature(key_id):
+    """An OpenPGP v3 RSA signature packet in the old format."""
+    body = ("\x03\x05\x00" + "\x00" * 4 + key_id.decode("hex") +
+            "\x01\x08\xab\xcd" + "\x00\x08\xff")
+    return "\x88" + chr(len(body)) + body
+
+
+def make_rpm(filename, name="foo", signature=None, sigtag=rpmfile.SIGTAG_RSA):
+    """Write a minimal RPM, signed with the packet signature if given."""
+    string = rpmfile.RPM_STRING_TYPE
+    header = _header([
+        (rpmfile.RPMTAG_NAME, string, name + "\0", 1),
+        (rpmfile.RPMTAG_VERSION, string, "1.0\0", 1),
+        (rpmfile.RPMTAG_RELEASE, string, "1.el6\0", 1),
+        (rpmfile.RPMTAG_ARCH, string, "x86_64\0", 1),
+        (rpmfile.RPMTAG_SOURCERPM, string, name + "-1.0-1.el6.src.rpm\0", 1),
+    ])
+    payload = "payload of " + name
+    entries = [(RPMSIGTAG_SIZE, rpmfile.RPM_INT32_TYPE,
+                struct.pack(">I", len(header) + len(payload)), 1)]
+    if signature:
+        entries.append((sigtag, 7, signature, len(signature)))
+    signature_header = _header(entries)
+    signature_header += "\0" * ((8 - len(signature_header) % 8) % 8)
+    lead = rpmfile.LEAD_MAGIC + "\0" * (rpmfile.LEAD_SIZE - len(rpmfile.LEAD_MAGIC))
+    with open(filename, "wb") as fp:
+        fp.write(lead + signature_header + header + payload)
+
+
+class RpmvercmpTest(unittest.TestCase):
+
+    def check(self, a, b, expected):
+        result = rpmvercmp(a, b)
+        self.assertEqual(cmp(result, 0), expected,
+                         "rpmvercmp({0!r}, {1!r}) = {2}".format(a, b, result))
+        self.assertEqual(cmp(rpmvercmp(b, a), 0), -expected)
+
+    def test_numeric(self):
+        self.check("1.0", "1.0", 0)
+        self.check("1.0", "2.0", -1)
+        self.check("2.0", "2.0.1", -1)
+        self.check("4.999.9", "5.0", -1)
+        self.check("20101121", "20101122", -1)
+
+    def test_numbers_compare_by_value(self):
+        self.check("5.5p10", "5.5p1", 1)
+        self.check("1.10", "1.9", 1)
+
+    def test_leading_zeros(self):
+        self.check("10.0001", "10.1", 0)
+        self.check("10.0001", "10.0039", -1)
+        self.check("1.010", "1.9", 1)
+
+    def test_alpha(self):
+        self.check("1.0aa", "1.0aa", 0)
+        self.check("1.0a", "1.0aa", -1)
+        self.check("10b2", "10a1", 1)
+        self.check("2.0.1a", "2.0.1", 1)
+
+    def test_alpha_older_than_numeric(self):
+        self.check("xyz.4", "8", -1)
+        self.check("xyz.4", "2", -1)
+        self.check("6.0.rc1", "6.0", 1)
+        self.check("1b.fc17", "1.fc17", -1)
+        self.check("1g.fc17", "1.fc17", 1)
+
+    def test_separators(self):
+        self.check("2.0", "2_0", 0)
+        self.check("a+", "a_", 0)
+        self.check("+", "_", 0)
+        self.check("10xyz", "10.1xyz", -1)
+
+    def test_tilde(self):
+        self.check("1.0~rc1", "1.0~rc1", 0)
+        self.check("1.0~rc1", "1.0", -1)
+        self.check("1.0~rc1", "1.0~rc2", -1)
+        self.check("1.0~rc1~git123", "1.0~rc1", -1)
+        self.check("1.0~rc1", "1.0.0", -1)
+
+    def test_caret(self):
+        self.check("1.0^", "1.0", 1)
+        self.check("1.0^git1", "1.0", 1)
+        self.check("1.0^git1", "1.01", -1)
+        self.check("1.0^git1", "1.0^git2", -1)
+        self.check("1.0^git1~pre", "1.0^git1", -1)
+        self.check("1.0~rc1^git1", "1.0~rc1", 1)
+
+    def test_empty(self):
+        self.check("", "", 0)
+        self.check(None, "1", -1)
+        self.check("", "a", -1)
+
+
+class CompareEVRTest(unittest.TestCase):
+
+    def test_missing_epoch_is_zero(self):
+        self.assertEqual(compare_evr((None, "1.0", "1"), ("0", "1.0", "1")), 0)
+        self.assertEqual(compare_evr(("", "1.0", "1"), (None, "1.0", "1")), 0)
+
+    def test_epoch_wins(self):
+        self.assertEqual(compare_evr(("1", "1.0", "1"), (None, "2.0", "9")), 1)
+        self.assertEqual(compare_evr(("2", "1.0", "1"), ("10", "1.0", "1")), -1)
+
+    def test_version_before_release(self):
+        self.assertEqual(compare_evr((None, "1.1", "1"), (None, "1.0", "9")), 1)
+        self.assertEqual(compare_evr((None, "1.0", "1.el6"), (None, "1.0", "2.el6")), -1)
+        self.assertEqual(compare_evr((None, "1.0", "1.el6"), (None, "1.0", "1.el6")), 0)
+
+
+class SignaturePacketTest(unittest.TestCase):
+
+    def test_v4_issuer_in_unhashed_area(self):
+        packet = v4_signature(
+            hashed=_subpacket(2, "\x51\x00\x00\x00"),
+            unhashed=_subpacket(rpmfile.SUBPACKET_ISSUER, KEY_ID.decode("hex")))
+        self.assertEqual(pgp_signature_key_id(packet), KEY_ID)
+
+    def test_v4_issuer_fingerprint(self):
+        fingerprint = "\x04" + "\x11" * 12 + KEY_ID.decode("hex")
+        packet = v4_signature(
+            hashed=_subpacket(rpmfile.SUBPACKET_ISSUER_FPR, fingerprint))
+        self.assertEqual(pgp_signature_key_id(packet), KEY_ID)
+
+    def test_v4_without_issuer(self):
+        packet = v4_signature(hashed=_subpacket(2, "\x51\x00\x00\x00"))
+        self.assertEqual(pgp_signature_key_id(packet), None)
+
+    def test_v3_old_format(self):
+        self.assertEqual(pgp_signature_key_id(v3_signature(KEY_ID)), KEY_ID)
+
+    def test_not_a_signature(self):
+        # A public key packet
+        self.assertRaises(RPMFileError, pgp_signature_key_id, "\x99\x00\x01\x04")
+
+    def test_truncated(self):
+        packet = v4_signature(
+            unhashed=_subpacket(rpmfile.SUBPACKET_ISSUER, KEY_ID.decode("hex")))
+        self.assertRaises(RPMFileError, pgp_signature_key_id, packet[:8])
+
+
+class SignatureHeaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.unsigned = os.path.join(self.tmpdir, "unsigned.rpm")
+        self.signed = os.path.join(self.tmpdir, "signed.rpm")
+        make_rpm(self.unsigned)
+        make_rpm(self.signed, signature=v4_signature(
+            unhashed=_subpacket(rpmfile.SUBPACKET_ISSUER, KEY_ID.decode("hex"))))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_unsigned(self):
+        self.assertEqual(signature_key_id(self.unsigned), None)
+        self.assertEqual(read_package(self.unsigned).sigkey, None)
+
+    def test_signed(self):
+        self.assertEqual(signature_key_id(self.signed), KEY_ID)
+        info = read_package(self.signed)
+        self.assertEqual(info.sigkey, KEY_ID)
+        self.assertEqual((info.name, info.version, info.release, info.arch),
+                         ("foo", "1.0", "1.el6", "x86_64"))
+
+    def test_pgp_tag_preferred(self):
+        filename = os.path.join(self.tmpdir, "pgp.rpm")
+        make_rpm(filename, signature=v3_signature(KEY_ID), sigtag=rpmfile.SIGTAG_PGP)
+        self.assertEqual(signature_key_id(filename), KEY_ID)
+
+    def test_unaligned_signature_header(self):
+        # A signature of odd length leaves padding before the main header
+        filename = os.path.join(self.tmpdir, "odd.rpm")
+        make_rpm(filename, signature=v3_signature(KEY_ID) + "\x00")
+        self.assertEqual(read_package(filename).name, "foo")
+
+    def test_content_digest_ignores_signature(self):
+        unsigned = package_digests(self.unsigned)
+        signed = package_digests(self.signed)
+        self.assertNotEqual(unsigned[0], signed[0])
+        self.assertEqual(unsigned[1], signed[1])
+
+    def test_not_an_rpm(self):
+        filename = os.path.join(self.tmpdir, "text.rpm")
+        with open(filename, "w") as fp:
+            fp.write("not a package\n" * 20)
+        self.assertRaises(RPMFileError, signature_key_id, filename)
+        self.assertRaises(RPMFileError, read_package, filename)
+
+
+if __name__ == "__main__":
+    unittest.main()